@@ -116,6 +116,19 @@ WHAT_MESSAGES = [
     "A time-saver.",
 ]
 
+# session state entries that hold most of a session's memory
+ACCOUNTED_STATE = [
+    "history",
+    "setup_messages",
+    "complete_history",
+    "tables",
+    "tool_list",
+    "demo_tool_data",
+    "conversation",
+    "docsum",
+    "prompts",
+]
+
 HOW_MESSAGES = [
     "Building wrappers around LLMs to tune their responses and ameliorate their shortcomings.",
     "Connecting to complementary technology, such as (vector) databases and model chaining.",
@@ -132,18 +145,113 @@ HOW_MESSAGES = [
 # IMPORTS
 import os
 import datetime
+from loguru import logger
 from chatgse._interface import ChatGSE
-from chatgse._interface import community_possible
-from biochatter._stats import get_community_usage_cost
+from chatgse._interface import community_possible, COMPACTION_FRACTION
+from chatgse._session_store import SessionStore
+from chatgse._memory import MemoryAccountant, MB
+from chatgse._cache import ResponseCache
+from chatgse._scheduler import RequestScheduler
+from chatgse._http import ClientPool
+from chatgse._llm import QUERY_DEADLINE
+from chatgse._correction import BATCH_SIZE
+from biochatter._stats import (
+    DEFAULT_USER,
+    get_community_usage_cost,
+    get_stats,
+)
 from biochatter.vectorstore import (
     DocumentEmbedder,
     DocumentReader,
 )
 from biochatter.llm_connect import OPENAI_MODELS, HUGGINGFACE_MODELS
+from chatgse._mock import MOCK_MODELS, mock_enabled
+from chatgse._router import MODEL_TABLE, cost, router_models
+from chatgse._batch import run_batch, to_csv, to_jsonl
 from pymilvus.exceptions import MilvusException
 
 
 # HANDLERS
+@st.cache_resource
+def session_store():
+    """
+    Process-wide store for persisting sessions across app reloads.
+    """
+    return SessionStore(os.getenv("CHATGSE_SESSION_DB", "sessions/chatgse.db"))
+
+
+@st.cache_resource
+def response_cache():
+    """
+    Process-wide cache of model responses, shared by all sessions.
+    """
+    return ResponseCache(
+        os.getenv("CHATGSE_CACHE_DB", "sessions/responses.db")
+    )
+
+
+@st.cache_resource
+def request_scheduler():
+    """
+    Process-wide queue for requests on the community key.
+    """
+    return RequestScheduler()
+
+
+@st.cache_resource
+def http_pool():
+    """
+    Process-wide HTTP connections to the model APIs, shared by all sessions.
+    """
+    pool = ClientPool()
+    pool.install()
+    return pool
+
+
+@st.cache_resource
+def memory_accountant():
+    """
+    Process-wide account of the memory used by the sessions.
+    """
+    return MemoryAccountant()
+
+
+def account_memory():
+    """
+    Report the memory footprint of the current session, and spill tables of
+    idle sessions to disk if all sessions together exceed the limit.
+    """
+    accountant = memory_accountant()
+    footprint = accountant.update(
+        ss.session_token,
+        {key: ss.get(key) for key in ACCOUNTED_STATE},
+    )
+    logger.debug(f"Session memory: {footprint / MB:.1f} MB")
+    accountant.enforce()
+
+
+def restore_or_register_session(cg: ChatGSE):
+    """
+    Register a new session token. If the `session` query parameter names a
+    session known to the session store, it is held to be resumed once a
+    matching API key is given (see `ChatGSE.restore_session`). Otherwise, the
+    new token is put into the query parameters, so that reloading the page
+    restores the session.
+
+    Args:
+        cg: current ChatGSE instance
+    """
+    token = st.experimental_get_query_params().get("session", [None])[0]
+    session = session_store().load(token) if token else None
+
+    ss.session_token = SessionStore.new_token()
+    if session:
+        logger.info("Holding session until the API key is given.")
+        cg.restore_session(token, session)
+    else:
+        st.experimental_set_query_params(session=ss.session_token)
+
+
 def update_api_keys():
     """
     Looks for API keys of supported services in the environment variables and
@@ -413,11 +521,28 @@ def app_header():
         )
 
 
+def get_estimated_usage_cost():
+    """
+    Cost of the community usage of the day that was estimated instead of
+    reported by the API, e.g. of streamed responses; it is counted apart from
+    the billed usage (see `chatgse._llm.record_usage`).
+    """
+    data = get_stats(user=DEFAULT_USER).get(f"usage:[date]:{DEFAULT_USER}")
+    return sum(
+        cost(
+            model,
+            data.get(f"estimated_prompt_tokens:{model}", 0),
+            data.get(f"estimated_completion_tokens:{model}", 0),
+        )
+        for model in MODEL_TABLE
+    )
+
+
 def get_remaining_tokens():
     """
     Fetch the percentage of remaining tokens for the day from the _stats module.
     """
-    used = get_community_usage_cost()
+    used = get_community_usage_cost() + get_estimated_usage_cost()
     limit = float(99 / 30)
     pct = (100.0 * (limit - used) / limit) if limit else 0
     pct = max(0, pct)
@@ -447,27 +572,59 @@ def remaining_tokens():
     st.progress(rt / 100)
 
 
-def display_token_usage():
+def display_token_usage(cg: ChatGSE):
     """
-    Display the token usage for the current conversation.
+    Display the token usage for the current conversation, and the projected
+    size of the next query.
     """
     with st.expander("Token usage", expanded=True):
-        maximum = ss.get("token_limit", 0)
+        maximum = cg._token_limit() if "token_limit" in ss else 0
+        projected = cg.projected_tokens()
+        # cached responses cost nothing; streamed and stopped responses
+        # report no usage
+        note = (
+            " (cached)"
+            if ss.token_usage.get("cached")
+            else " (estimated)"
+            if ss.token_usage.get("estimated")
+            else ""
+        )
 
         st.markdown(
             f"""
-            Last query: {ss.token_usage["prompt_tokens"]}
+            Next query (projected): {projected} + your message
 
-            Last response: {ss.token_usage["completion_tokens"]}
+            Last query: {ss.token_usage["prompt_tokens"]}{note}
 
-            Total usage: {ss.token_usage["total_tokens"]}
+            Last response: {ss.token_usage["completion_tokens"]}{note}
+
+            Total usage: {ss.token_usage["total_tokens"]}{note}
 
             Model maximum: {maximum}
+
+            Last model: {ss.get("routed_model", ss.get("primary_model"))}
+
+            Saved by compaction: {ss.get("compaction_saved", 0)}
             """
         )
 
+        st.slider(
+            "Compact the conversation above this share of the maximum",
+            min_value=0.5,
+            max_value=1.0,
+            value=COMPACTION_FRACTION,
+            step=0.05,
+            key="compaction_fraction",
+            help=(
+                "Before each query, the oldest exchanges are replaced by a "
+                "short summary of the questions asked if the prompt would "
+                "exceed this share of the model maximum. Prompts and tool "
+                "data are always kept. Set to 1.0 to disable compaction."
+            ),
+        )
+
         # display warning within 20% of maximum
-        if ss.token_usage["total_tokens"] > maximum * 0.8:
+        if max(ss.token_usage["total_tokens"], projected) > maximum * 0.8:
             st.warning(
                 "You are approaching the maximum number of tokens allowed by "
                 "the model. Please consider using a different model or "
@@ -476,6 +633,146 @@ def display_token_usage():
             )
 
 
+def chat_settings():
+    """
+    Select whether responses are streamed, whether slow requests are hedged,
+    how long a response may take, and how many of the most recent turns of
+    the conversation are rendered in full. Older turns are collapsed and
+    only rendered on request.
+    """
+    with st.expander("Chat settings", expanded=False):
+        st.checkbox(
+            "Stream responses",
+            value=True,
+            key="stream_responses",
+            help=(
+                "Show the response of the model while it is being generated. "
+                "Models that do not support streaming show the response once "
+                "it is complete."
+            ),
+        )
+        st.checkbox(
+            "Route queries by size",
+            value=False,
+            key="route_models",
+            help=(
+                "Send each query to the cheapest model whose context fits it, "
+                f"out of {', '.join(router_models())}. Short questions go to "
+                "the small model, long conversations to the large one. Only "
+                "models of the same kind as the selected one are used, and "
+                "none more expensive with the community key. Only available "
+                "for OpenAI models."
+            ),
+        )
+        st.checkbox(
+            "Hedge slow requests",
+            value=False,
+            key="hedge_requests",
+            help=(
+                "Send a second request when the model takes longer than it "
+                "usually does, and use whichever answer arrives first. This "
+                "can cost additional tokens. Not available with the community "
+                "key."
+            ),
+        )
+        st.number_input(
+            "Deadline (seconds)",
+            min_value=0,
+            value=int(QUERY_DEADLINE),
+            step=10,
+            key="query_deadline",
+            help=(
+                "Stop a response that takes longer than this, keeping what "
+                "has arrived so far. Set to 0 to wait as long as it takes. A "
+                "response can also be stopped with the Stop button."
+            ),
+        )
+        st.number_input(
+            "Fully rendered turns",
+            min_value=0,
+            value=0,
+            step=1,
+            key="history_window",
+            help=(
+                "Older turns are collapsed and only loaded when opened, which "
+                "keeps long conversations with large tool tables responsive. "
+                "Set to 0 to always show the full conversation."
+            ),
+        )
+
+
+def sidebar_panel(cg: ChatGSE):
+    """
+    Sidebar panels for token usage, downloads, model selection, and metrics.
+
+    Args:
+        cg: current ChatGSE instance
+    """
+    display_token_usage(cg)
+    d1, d2 = st.columns(2)
+    with d1:
+        download_chat_history(cg)
+    with d2:
+        download_complete_history(cg)
+    model_select()
+    display_metrics()
+
+
+def display_metrics():
+    """
+    Display the memory used by the current session and by all sessions, the
+    hits of the response cache, the reuse of HTTP connections, and the
+    requests of the last query.
+    """
+    with st.expander("Metrics", expanded=False):
+        accountant = memory_accountant()
+        metrics = accountant.metrics()
+        st.metric(
+            "Session memory",
+            f"{accountant.footprint(ss.session_token) / MB:.1f} MB",
+        )
+        st.metric(
+            "All sessions",
+            f"{metrics['total_bytes'] / MB:.1f} MB",
+            help=(
+                f"{metrics['sessions']} sessions; "
+                f"{metrics['spilled_bytes'] / MB:.1f} MB of tables of idle "
+                "sessions spilled to disk"
+            ),
+        )
+        cache = response_cache().metrics()
+        hits = sum(cache["hits"].values())
+        lookups = hits + sum(cache["misses"].values())
+        st.metric(
+            "Response cache hits",
+            f"{hits} / {lookups}",
+            help=(
+                f"{cache['entries']} cached responses; "
+                f"{cache['hits'].get('correction', 0)} of the hits were "
+                "corrections"
+            ),
+        )
+        connections = http_pool().metrics()
+        requests = sum(row["requests"] for row in connections)
+        opened = sum(row["connections"] for row in connections)
+        st.metric(
+            "Connections reused",
+            f"{requests - opened} / {requests}",
+            help=(
+                f"{opened} connections opened to "
+                f"{len({row['endpoint'] for row in connections})} endpoints, "
+                f"{sum(row['handshakes'] for row in connections)} TLS "
+                "handshakes"
+            ),
+        )
+        if ss.get("request_timings"):
+            st.caption("Requests of the last query")
+            st.table(ss.request_timings)
+        if connections:
+            st.caption("HTTP connections by endpoint and key")
+            st.table(connections)
+
+
 def model_select():
     """
     Select the primary model to use for the conversation.
@@ -487,6 +784,8 @@ def model_select():
 
         # concatenate OPENAI_MODELS and HUGGINGFACE_MODELS
         models = OPENAI_MODELS + HUGGINGFACE_MODELS
+        if mock_enabled():
+            models += MOCK_MODELS
         st.selectbox(
             "Primary model",
             options=models,
@@ -675,10 +974,9 @@ def download_chat_history(cg: ChatGSE):
     Args:
         cg: current ChatGSE instance
     """
-    cg.update_json_history()
     st.download_button(
         label="Download Chat History",
-        data=ss.json_history,
+        data=cg.chat_history_json(),
         file_name="chat_history.json",
         mime="application/json",
         use_container_width=True,
@@ -688,14 +986,13 @@ def download_chat_history(cg: ChatGSE):
 def download_complete_history(cg: ChatGSE):
     """
     Button to download the complete message history (i.e., including the
-    system prompts) as a JSON file.
+    system prompts) as a JSON file. The JSON is extended with new messages
+    only (see `ChatGSE.complete_history`).
 
     Args:
         cg: current ChatGSE instance
     """
-    d = cg.complete_history()
-
-    if d == "{}":
+    if not cg.has_complete_history():
         st.download_button(
             label="Download Message History",
             data="",
@@ -706,7 +1003,7 @@ def download_complete_history(cg: ChatGSE):
 
     st.download_button(
         label="Download Message History",
-        data=d,
+        data=cg.complete_history(),
         file_name="complete_history.json",
         mime="application/json",
         use_container_width=True,
@@ -985,10 +1282,14 @@ def reset_button():
 
 def reset_app():
     """
-    Reset the app to its initial state.
+    Reset the app to its initial state, and delete the persisted session.
     """
+    token = ss.get("session_token")
+    if token:
+        session_store().put(SessionStore.delete_ops(token), token)
     ss.clear()
     ss._primary_model = "gpt-3.5-turbo"
+    st.experimental_set_query_params()
 
 
 def show_about_section():
@@ -1283,30 +1584,53 @@ def toggle_split_by_characters():
 
 
 def correcting_agent_panel():
-    ss.split_correction = st.checkbox(
-        "Split the response into sentences for correction",
-        value=False,
-    )
+    c1, c2 = st.columns(2)
+    with c1:
+        ss.split_correction = st.checkbox(
+            "Split the response into sentences for correction",
+            value=False,
+        )
+    with c2:
+        ss.correction_batch_size = st.number_input(
+            "Sentences per correction request",
+            min_value=1,
+            max_value=20,
+            # CHATGSE_CORRECTION_BATCH_SIZE may lie outside the bounds
+            value=min(max(BATCH_SIZE, 1), 20),
+            disabled=not ss.split_correction,
+            help=(
+                "Check several sentences in one request, which saves sending "
+                "the correcting prompts again for each sentence. Set to 1 to "
+                "check each sentence on its own."
+            ),
+        )
 
     if ss.get("conversation"):
         if ss.split_correction != ss.conversation.split_correction:
             ss.conversation.split_correction = ss.split_correction
+        ss.conversation.correction_batch_size = ss.correction_batch_size
+
+    with st.form("test_correction"):
+        test_correct = st.text_area(
+            "Test correction functionality here:",
+            placeholder=(
+                "Enter a false statement to prompt a correction. Press "
+                "[Enter] for a new line, and [CTRL+Enter] or [⌘+Enter] to "
+                "submit."
+            ),
+        )
+        submitted = st.form_submit_button("Test Correction")
 
-    test_correct = st.text_area(
-        "Test correction functionality here:",
-        placeholder=(
-            "Enter a false statement to prompt a correction. Press [Enter] for "
-            "a new line, and [CTRL+Enter] or [⌘+Enter] to submit."
-        ),
-    )
-
-    if test_correct:
+    if submitted and test_correct:
         if not ss.get("conversation"):
             st.write("No model loaded. Please load a model first.")
             return
 
-        correction = ss.conversation._correct_response(test_correct)
+        with st.spinner("Correcting ..."):
+            ss.correction_test = test_correction(test_correct)
 
+    if ss.get("correction_test"):
+        correction = ss.correction_test
         if str(correction).lower() in ["ok", "ok."]:
             st.success("The model found no correction to be required.")
         else:
@@ -1315,6 +1639,40 @@ def correcting_agent_panel():
             )
 
 
+def test_correction(text: str):
+    """
+    Have the correcting agent check a test statement. Results are kept in
+    the session by statement, correcting prompts and model, so that the
+    same test is not sent twice, and in the response cache, so that other
+    sessions can reuse them.
+
+    Returns:
+        str: the correction, or "OK"
+    """
+    conversation = ss.conversation
+    cache = response_cache()
+    key = cache.key(
+        "correction_test",
+        getattr(conversation, "ca_model_name", conversation.model_name),
+        conversation.prompts.get("correcting_agent_prompts"),
+        conversation.ca_messages,
+        text,
+    )
+    tested = ss.setdefault("correction_tests", {})
+    if key in tested:
+        return tested[key]
+
+    cached = cache.get(key, namespace="correction_test")
+    if cached:
+        correction = cached[0]
+    else:
+        correction = conversation._correct_response(text)
+        cache.put(key, correction, {}, namespace="correction_test")
+
+    tested[key] = correction
+    return correction
+
+
 def refresh():
     ss.input = ""
     st.experimental_rerun()
@@ -1408,7 +1766,216 @@ def waiting_for_docsum():
     st.info("Use the 'Document Summarisation' tab to embed documents.")
 
 
+# TODO: run the tab bodies and `sidebar_panel` as `st.fragment`s, so that
+# their widgets rerun only their own part of the page, and compare rerun
+# times; fragments need Streamlit >= 1.37 (poetry.lock pins 1.24.1)
+def annot_tab_body():
+    """
+    Cell type annotation tab.
+    """
+    if ss.user == "community":
+        st.markdown(f"{DEV_FUNCTIONALITY}")
+    else:
+        st.markdown(
+            "A common repetitive task in bioinformatics is to annotate "
+            "single-cell datasets with cell type labels. This task is usually "
+            "performed by a human expert, who will look at the expression of "
+            "marker genes and assign a cell type label based on their "
+            "knowledge of the cell types present in the tissue of interest. "
+            "Large Language Models have been shown to be able to perform this "
+            "task with high accuracy, and can be used to automate cell type "
+            "annotation with minimal human input (see e.g. [this arXiv "
+            "preprint](https://www.biorxiv.org/content/10.1101/2023.04.16.537094v1))."
+        )
+        st.markdown(
+            f"`📎 Assistant`: Cell type annotation {OFFLINE_FUNCTIONALITY}"
+        )
+
+
+def exp_design_tab_body():
+    """
+    Experimental design tab.
+    """
+    st.markdown(
+        "Experimental design is a crucial step in any biological experiment. "
+        "However, it can be a subtle and complex task, requiring a deep "
+        "understanding of the biological system under study as well as "
+        "statistical and computational expertise. Large Language Models "
+        "can potentially fill the gaps that exist in most research groups, "
+        "which traditionally focus on either the biological or the "
+        "statistical aspects of experimental design."
+    )
+    st.markdown(
+        f"`📎 Assistant`: Experimental design functionality {OFFLINE_FUNCTIONALITY}"
+    )
+
+
+def prompts_tab_body():
+    """
+    Prompt engineering tab.
+    """
+    st.markdown(
+        "The construction of prompts is a crucial step in the use of "
+        "Large Language Models. However, it can be a subtle and complex "
+        "task, often requiring empirical testing on prompt composition "
+        "due to the black-box nature of the models. We provide composable "
+        "prompts and prompt templates (which can include variables), as "
+        "well as save and load functionality for full prompt sets to "
+        "facilitate testing, reproducibility, and sharing."
+    )
+
+    if not ss.mode in [
+        "getting_key",
+        "using_community_key",
+        "getting_name",
+        "getting_context",
+    ]:
+        st.markdown(
+            "`📎 Assistant`: Prompt tuning is only available before "
+            "initialising the conversation, that is, before giving a "
+            "context. Please reset the app to tune the prompt set."
+        )
+        prompt_save_button()
+
+    else:
+        prompt_save_load_reset()
+        ss.prompts_box = st.selectbox(
+            "Select a prompt set",
+            (
+                "Primary Model",
+                "Correcting Agent",
+                "Tools",
+                "Document Summarisation",
+            ),
+        )
+
+        if ss.prompts_box == "Primary Model":
+            show_primary_model_prompts()
+
+        elif ss.prompts_box == "Correcting Agent":
+            show_correcting_agent_prompts()
+
+        elif ss.prompts_box == "Tools":
+            show_tool_prompts()
+
+        elif ss.prompts_box == "Document Summarisation":
+            show_docsum_prompts()
+
+
+def correct_tab_body():
+    """
+    Correcting agent tab.
+    """
+    st.markdown(
+        "Large Language Models are very good at synthesising information "
+        "from their training set, and thus can be useful to explain the "
+        "biological context of a particular gene set or cell type. "
+        "However, they can sometimes be incorrect or misleading, and "
+        "have been known to occasionally hallucinate while being very "
+        "convinced of their answer. To ameliorate this issue, we include "
+        "a correcting agent that automatically checks the validity of the "
+        "primary model's statements, and corrects them if necessary."
+    )
+    if ss.get("online"):
+        st.markdown(
+            f"`📎 Assistant`: Correction agent functionality {OFFLINE_FUNCTIONALITY}"
+        )
+    else:
+        correcting_agent_panel()
+
+
+def docsum_tab_body():
+    """
+    Document summarisation tab.
+    """
+    st.markdown(
+        "While Large Language Models have access to vast amounts of "
+        "knowledge, this knowledge only includes what was present in "
+        "their training set, and thus excludes very current research "
+        "as well as research articles that are not open access. To "
+        "fill in the gaps of the model's knowledge, we include a "
+        "document summarisation approach that stores knowledge from "
+        "user-provided documents in a vector database, which can be "
+        "used to supplement the model prompt by retrieving the most "
+        "relevant contents of the provided documents. This process "
+        "builds on the unique functionality of vector databases to "
+        "perform similarity search on the embeddings of the documents' "
+        "contents."
+    )
+    if ss.get("openai_api_key"):
+        docsum_panel()
+        if ss.get("first_document_uploaded"):
+            ss.first_document_uploaded = False
+            refresh()
+    else:
+        st.info(
+            "Please enter your OpenAI API key to use the document "
+            "summarisation functionality."
+        )
+
+
+def batch_tab_body():
+    """
+    Batch questions tab.
+    """
+    if ss.user == "community":
+        st.markdown(f"{DEV_FUNCTIONALITY}")
+        return
+
+    st.markdown(
+        "Ask a list of questions against the context and tool data of the "
+        "current conversation, for instance the meaning of each of a list of "
+        "pathways in your tissue of interest. Every question is answered "
+        "on its own, without the previous questions of the chat, and several "
+        "questions are sent at the same time. The same can be done from the "
+        "command line with `python -m chatgse._batch`."
+    )
+    if ss.get("mode") != "chat":
+        st.info(
+            "Please set up the conversation (context and tool data) in the "
+            "Chat tab first."
+        )
+        return
+
+    with st.form("batch_questions"):
+        questions = st.text_area(
+            "Questions (one per line)",
+            placeholder="What does JAK-STAT activity mean in PBMCs?",
+        )
+        concurrency = st.number_input(
+            "Concurrent requests", min_value=1, max_value=16, value=4
+        )
+        submitted = st.form_submit_button("Answer Questions")
+
+    questions = [q.strip() for q in questions.splitlines() if q.strip()]
+    if submitted and questions:
+        with st.spinner(f"Answering {len(questions)} questions ..."):
+            ss.batch_results = run_batch(
+                ss.conversation, questions, int(concurrency)
+            )
+
+    if ss.get("batch_results"):
+        st.dataframe(ss.batch_results)
+        d1, d2 = st.columns(2)
+        with d1:
+            st.download_button(
+                "Download Answers (CSV)",
+                to_csv(ss.batch_results),
+                "chatgse-batch.csv",
+                "text/csv",
+            )
+        with d2:
+            st.download_button(
+                "Download Answers (JSONL)",
+                to_jsonl(ss.batch_results),
+                "chatgse-batch.jsonl",
+                "application/jsonl",
+            )
+
+
 def main():
+    http_pool()
+
     # NEW SESSION
     if not ss.get("mode"):
         _startup()
@@ -1422,6 +1989,10 @@ def main():
         ss.cg = ChatGSE()
     cg = ss.cg
 
+    # SESSION PERSISTENCE
+    if not ss.get("session_token"):
+        restore_or_register_session(cg)
+
     # CHANGE MODEL
     if not ss.get("active_model") == ss.primary_model:
         cg.set_model(ss.primary_model)
@@ -1429,6 +2000,10 @@ def main():
         ss.mode = cg._check_for_api_key(write=False, input=ss.input)
         # TODO: warn user that we are resetting?
 
+    # continue a restored session once the API key is set
+    if ss.get("restored_mode") and ss.mode == "getting_name":
+        ss.mode = ss.pop("restored_mode")
+
     # TOKEN USAGE
     if not ss.get("token_usage"):
         ss.token_usage = {
@@ -1450,6 +2025,7 @@ def main():
         annot_tab,
         exp_design_tab,
         correct_tab,
+        batch_tab,
     ) = st.tabs(
         [
             "Chat",
@@ -1458,6 +2034,7 @@ def main():
             "Cell Type Annotation",
             "Experimental Design",
             "Correcting Agent",
+            "Batch Questions",
         ]
     )
 
@@ -1475,7 +2052,11 @@ def main():
         if ss.show_setup:
             cg._display_setup()
 
-        cg._display_history()
+        # a correction still running from the last answer has to be added
+        # before the next question
+        cg._collect_correction(wait=bool(ss.input))
+
+        cg._display_history(window=ss.get("history_window", 0))
 
         # CHAT BOT LOGIC
         if ss.input or ss.mode == "waiting_for_docsum":
@@ -1527,7 +2108,10 @@ def main():
 
             elif ss.mode == "chat":
                 with st.spinner("Thinking ..."):
-                    ss.response, ss.token_usage = cg._get_response()
+                    ss.response, ss.token_usage = cg._get_response(
+                        cache=response_cache(),
+                        scheduler=request_scheduler(),
+                    )
 
             # DEMO LOGIC
             elif ss.mode == "demo_key":
@@ -1556,7 +2140,10 @@ def main():
 
             elif ss.mode == "demo_chat":
                 with st.spinner("Thinking ..."):
-                    ss.response, ss.token_usage = cg._get_response()
+                    ss.response, ss.token_usage = cg._get_response(
+                        cache=response_cache(),
+                        scheduler=request_scheduler(),
+                    )
                 cg._write_and_history(
                     "📎 Assistant",
                     "🎉 This concludes the demonstration. You can chat with the "
@@ -1576,6 +2163,9 @@ def main():
         # RESET INPUT
         ss.input = ""
 
+        # MEMORY
+        account_memory()
+
         # SIDEBAR
         with st.sidebar:
             app_header()
@@ -1591,13 +2181,8 @@ def main():
             ):
                 remaining_tokens()
                 community_select()
-            display_token_usage()
-            d1, d2 = st.columns(2)
-            with d1:
-                download_chat_history(cg)
-            with d2:
-                download_complete_history(cg)
-            model_select()
+            sidebar_panel(cg)
+            chat_settings()
 
         # CHAT BOX
 
@@ -1618,134 +2203,35 @@ def main():
         elif "demo" in ss.mode:
             demo_next_button()
         else:
-            if not ss.get("error"):
-                chat_box()
-                autofocus_area()
+            chat_box()
+            autofocus_area()
 
     with annot_tab:
-        if ss.user == "community":
-            st.markdown(f"{DEV_FUNCTIONALITY}")
-        else:
-            st.markdown(
-                "A common repetitive task in bioinformatics is to annotate "
-                "single-cell datasets with cell type labels. This task is usually "
-                "performed by a human expert, who will look at the expression of "
-                "marker genes and assign a cell type label based on their "
-                "knowledge of the cell types present in the tissue of interest. "
-                "Large Language Models have been shown to be able to perform this "
-                "task with high accuracy, and can be used to automate cell type "
-                "annotation with minimal human input (see e.g. [this arXiv "
-                "preprint](https://www.biorxiv.org/content/10.1101/2023.04.16.537094v1))."
-            )
-            st.markdown(
-                f"`📎 Assistant`: Cell type annotation {OFFLINE_FUNCTIONALITY}"
-            )
+        annot_tab_body()
 
     with exp_design_tab:
-        st.markdown(
-            "Experimental design is a crucial step in any biological experiment. "
-            "However, it can be a subtle and complex task, requiring a deep "
-            "understanding of the biological system under study as well as "
-            "statistical and computational expertise. Large Language Models "
-            "can potentially fill the gaps that exist in most research groups, "
-            "which traditionally focus on either the biological or the "
-            "statistical aspects of experimental design."
-        )
-        st.markdown(
-            f"`📎 Assistant`: Experimental design functionality {OFFLINE_FUNCTIONALITY}"
-        )
+        exp_design_tab_body()
 
     with prompts_tab:
-        st.markdown(
-            "The construction of prompts is a crucial step in the use of "
-            "Large Language Models. However, it can be a subtle and complex "
-            "task, often requiring empirical testing on prompt composition "
-            "due to the black-box nature of the models. We provide composable "
-            "prompts and prompt templates (which can include variables), as "
-            "well as save and load functionality for full prompt sets to "
-            "facilitate testing, reproducibility, and sharing."
-        )
-
-        if not ss.mode in [
-            "getting_key",
-            "using_community_key",
-            "getting_name",
-            "getting_context",
-        ]:
-            st.markdown(
-                "`📎 Assistant`: Prompt tuning is only available before "
-                "initialising the conversation, that is, before giving a "
-                "context. Please reset the app to tune the prompt set."
-            )
-            prompt_save_button()
+        prompts_tab_body()
 
-        else:
-            prompt_save_load_reset()
-            ss.prompts_box = st.selectbox(
-                "Select a prompt set",
-                (
-                    "Primary Model",
-                    "Correcting Agent",
-                    "Tools",
-                    "Document Summarisation",
-                ),
-            )
-
-            if ss.prompts_box == "Primary Model":
-                show_primary_model_prompts()
-
-            elif ss.prompts_box == "Correcting Agent":
-                show_correcting_agent_prompts()
+    with correct_tab:
+        correct_tab_body()
 
-            elif ss.prompts_box == "Tools":
-                show_tool_prompts()
+    with docsum_tab:
+        docsum_tab_body()
 
-            elif ss.prompts_box == "Document Summarisation":
-                show_docsum_prompts()
+    with batch_tab:
+        batch_tab_body()
 
-    with correct_tab:
-        st.markdown(
-            "Large Language Models are very good at synthesising information "
-            "from their training set, and thus can be useful to explain the "
-            "biological context of a particular gene set or cell type. "
-            "However, they can sometimes be incorrect or misleading, and "
-            "have been known to occasionally hallucinate while being very "
-            "convinced of their answer. To ameliorate this issue, we include "
-            "a correcting agent that automatically checks the validity of the "
-            "primary model's statements, and corrects them if necessary."
-        )
-        if ss.get("online"):
-            st.markdown(
-                f"`📎 Assistant`: Correction agent functionality {OFFLINE_FUNCTIONALITY}"
-            )
-        else:
-            correcting_agent_panel()
+    # CORRECTION
+    # the answer is already shown; wait for its correction once the rest of
+    # the page is rendered
+    with chat_tab:
+        if cg._collect_correction(wait=True):
+            refresh()
 
-    with docsum_tab:
-        st.markdown(
-            "While Large Language Models have access to vast amounts of "
-            "knowledge, this knowledge only includes what was present in "
-            "their training set, and thus excludes very current research "
-            "as well as research articles that are not open access. To "
-            "fill in the gaps of the model's knowledge, we include a "
-            "document summarisation approach that stores knowledge from "
-            "user-provided documents in a vector database, which can be "
-            "used to supplement the model prompt by retrieving the most "
-            "relevant contents of the provided documents. This process "
-            "builds on the unique functionality of vector databases to "
-            "perform similarity search on the embeddings of the documents' "
-            "contents."
-        )
-        if ss.get("openai_api_key"):
-            docsum_panel()
-            if ss.get("first_document_uploaded"):
-                ss.first_document_uploaded = False
-                refresh()
-        else:
-            st.info(
-                "Please enter your OpenAI API key to use the document "
-                "summarisation functionality."
-            )
+    cg.save_session(session_store())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+# Memory benchmark: per-message overhead of the chat history layouts
+#
+# Usage: python -m benchmark.history_memory [n_messages]
+#
+# Compares the previous layout of ss.history (a list of single-key dicts) with
+# chatgse._history.MessageLog. Message strings are created up front and shared
+# by both layouts, so only the container overhead is measured.
+
+import sys
+import tracemalloc
+
+from chatgse._history import MessageLog
+
+ROLES = ["📎 Assistant", "💬🧬 ChatGSE", "🕵️ Correcting agent", "tool"]
+
+
+def _messages(n: int):
+    # user name roles are typed at runtime, so build them dynamically as well
+    user = "".join(["Demo", " ", "User"])
+    roles = ROLES + [user]
+    return [
+        ("".join(r for r in roles[i % len(roles)]), f"message number {i}")
+        for i in range(n)
+    ]
+
+
+def _measure(build, messages):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    history = build(messages)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, "filename"))
+    del history
+    return size
+
+
+def dict_layout(messages):
+    history = []
+    for role, msg in messages:
+        history.append({role: msg})
+    return history
+
+
+def log_layout(messages):
+    history = MessageLog()
+    for role, msg in messages:
+        history.append(role, msg)
+    return history
+
+
+def main(n: int = 10_000):
+    messages = _messages(n)
+    for name, build in [
+        ("list of dicts", dict_layout),
+        ("MessageLog", log_layout),
+    ]:
+        size = _measure(build, messages)
+        print(f"{name:>14}: {size:>10,} bytes, {size / n:6.1f} bytes/message")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
@@ -0,0 +1,67 @@
+# Latency benchmark: serial, parallel and batched sentence-level correction
+#
+# Usage: python -m benchmark.sentence_correction [n_sentences] [latency]
+#
+# Corrects a response of n sentences with split_correction, against the mock
+# backend (chatgse._mock), whose correcting agent takes a fixed latency per
+# request. The serial path checks one sentence after the other, as biochatter
+# does; the parallel path uses chatgse._correction.SENTENCE_EXECUTOR; the
+# batched path also sends several sentences per request. The mock latency
+# does not grow with the size of a request, so the gain of batching is an
+# upper bound.
+
+import sys
+import time
+
+from chatgse._correction import BATCH_SIZE, SENTENCE_EXECUTOR, correct_query
+from chatgse._mock import MockConversation, MockModel
+
+PROMPTS = {
+    "primary_model_prompts": [],
+    "correcting_agent_prompts": ["Check the statements."],
+    "tool_prompts": {},
+}
+
+
+def _response(n: int):
+    return " ".join(
+        f"Sentence number {i} is about pathway activity." for i in range(n)
+    )
+
+
+def _measure(conversation, msg: str, repeats: int = 3, **kwargs):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        correct_query(conversation, msg, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(n: int = 10, latency: float = 0.2):
+    conversation = MockConversation(
+        model_name="mock",
+        prompts=PROMPTS,
+        split_correction=True,
+        model=MockModel(latency=latency, sigma=0, error_rate=0),
+    )
+    msg = _response(n)
+    workers = SENTENCE_EXECUTOR._max_workers
+    print(
+        f"{n} sentences, {latency} s per correction, {workers} workers, "
+        f"{BATCH_SIZE} sentences per batch"
+    )
+    serial = _measure(conversation, msg, parallel=False, batch_size=1)
+    for name, seconds in [
+        ("serial", serial),
+        ("parallel", _measure(conversation, msg, batch_size=1)),
+        ("batched", _measure(conversation, msg, batch_size=BATCH_SIZE)),
+    ]:
+        print(f"{name:>9}: {seconds:6.2f} s, {serial / seconds:4.1f}x")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 0.2,
+    )
@@ -0,0 +1,251 @@
+# ChatGSE batch questions
+# answer a list of questions against one context and one set of tool data
+#
+# Usage:
+#   python -m chatgse._batch --prompts prompts.json --context "PBMCs" \
+#       --tool progeny.csv --questions questions.txt --out answers.csv
+#
+# The prompt set is the JSON file saved in the "Prompt Engineering" tab.
+# Questions are read one per line. The OpenAI key is taken from
+# OPENAI_API_KEY.
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import pandas as pd
+from langchain.schema import HumanMessage
+from loguru import logger
+from biochatter.llm_connect import (
+    GptConversation,
+    OPENAI_MODELS,
+)
+
+from chatgse._compaction import chat_start
+from chatgse._correction import correct_query
+from chatgse._llm import resilient_completion
+from chatgse._mock import MockConversation, MOCK_MODELS
+from chatgse._prompts import apply_prompts
+
+COLUMNS = [
+    "question",
+    "answer",
+    "correction",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "seconds",
+    "error",
+]
+
+
+def setup_conversation(
+    model_name: str,
+    prompts: dict,
+    context: str,
+    tools: list = None,
+    api_key: str = None,
+    correct: bool = True,
+    split_correction: bool = False,
+    correction_batch_size: int = None,
+):
+    """
+    Set up a conversation with the prompts, the context and the tool data,
+    as the chat does before the first question.
+
+    Args:
+        model_name: the primary model
+
+        prompts: the prompt set
+
+        context: the topic of the research
+
+        tools: paths of tool result tables (CSV or TSV); the tool is
+            recognised by the file name, as in the chat
+
+        api_key: the OpenAI API key
+
+        correction_batch_size: sentences per correction request with
+            `split_correction` (default: CHATGSE_CORRECTION_BATCH_SIZE, 5)
+
+    Returns:
+        Conversation: the conversation, ready for questions
+    """
+    if model_name in MOCK_MODELS:
+        conversation = MockConversation(
+            model_name=model_name,
+            prompts=prompts,
+            correct=correct,
+            split_correction=split_correction,
+        )
+    elif model_name in OPENAI_MODELS:
+        conversation = GptConversation(
+            model_name=model_name,
+            prompts=prompts,
+            correct=correct,
+            split_correction=split_correction,
+        )
+    else:
+        raise ValueError(f"Model {model_name} is not supported in batches.")
+
+    if correction_batch_size:
+        conversation.correction_batch_size = correction_batch_size
+
+    if not conversation.set_api_key(api_key, "batch"):
+        raise ValueError("The API key is not valid.")
+
+    apply_prompts(conversation, context)
+    for path in tools or []:
+        name = os.path.basename(path)
+        sep = "\t" if "tsv" in name else ","
+        df = pd.read_csv(path, sep=sep)
+        conversation.setup_data_input_tool(
+            df.to_json(), name.split(".")[0].lower()
+        )
+
+    return conversation
+
+
+def answer(conversation, messages: list, question: str):
+    """
+    Answer one question without changing the conversation.
+
+    Returns:
+        dict: the answer, its correction, token usage and time, as in
+            `COLUMNS`
+    """
+    start = time.perf_counter()
+    result = {"question": question, "correction": None, "error": None}
+
+    msg, token_usage = resilient_completion(
+        conversation, messages + [HumanMessage(content=question)]
+    )
+    if not token_usage:
+        result["error"] = msg
+        msg = None
+        token_usage = {}
+
+    elif conversation.correct:
+        try:
+            corrections = correct_query(conversation, msg)
+            result["correction"] = "\n".join(corrections) or None
+        except openai.error.OpenAIError as e:
+            result["error"] = f"Correction failed: {e}"
+
+    result["answer"] = msg
+    for key in ["prompt_tokens", "completion_tokens", "total_tokens"]:
+        result[key] = token_usage.get(key, 0)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return {key: result[key] for key in COLUMNS}
+
+
+def run_batch(conversation, questions: list, concurrency: int = 4):
+    """
+    Answer a list of questions against the setup of a conversation: its
+    messages before the first question (prompts, context, tool data and its
+    description; see `chat_start`), without any previous questions.
+    Questions are sent concurrently, with at most `concurrency` requests at a
+    time.
+
+    Returns:
+        list: one result per question, in the order of the questions
+    """
+    messages = conversation.messages[: chat_start(conversation.messages)]
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        return list(
+            pool.map(lambda q: answer(conversation, messages, q), questions)
+        )
+
+
+def to_csv(results: list):
+    return pd.DataFrame(results, columns=COLUMNS).to_csv(index=False)
+
+
+def to_jsonl(results: list):
+    return "".join(json.dumps(result) + "\n" for result in results)
+
+
+def write_results(results: list, path: str):
+    """
+    Write batch results to CSV or, for paths ending in .jsonl, JSON lines.
+    """
+    with open(path, "w") as f:
+        if path.endswith(".jsonl"):
+            f.write(to_jsonl(results))
+        else:
+            f.write(to_csv(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Answer a list of questions against one context."
+    )
+    parser.add_argument(
+        "--prompts", required=True, help="prompt set JSON file"
+    )
+    parser.add_argument(
+        "--context", default="", help="the topic of the research"
+    )
+    parser.add_argument(
+        "--tool",
+        action="append",
+        default=[],
+        help="tool result table (CSV/TSV); can be given several times",
+    )
+    parser.add_argument(
+        "--questions", required=True, help="text file, one question per line"
+    )
+    parser.add_argument(
+        "--out", required=True, help="output file (.csv or .jsonl)"
+    )
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--no-correct",
+        action="store_true",
+        help="do not check the answers with the correcting agent",
+    )
+    parser.add_argument(
+        "--split-correction",
+        action="store_true",
+        help="correct the answers sentence by sentence",
+    )
+    parser.add_argument(
+        "--correction-batch-size",
+        type=int,
+        help="sentences per correction request with --split-correction",
+    )
+    args = parser.parse_args()
+
+    with open(args.prompts) as f:
+        prompts = json.load(f)
+    with open(args.questions) as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    conversation = setup_conversation(
+        args.model,
+        prompts,
+        args.context,
+        tools=args.tool,
+        api_key=os.getenv("OPENAI_API_KEY"),
+        correct=not args.no_correct,
+        split_correction=args.split_correction,
+        correction_batch_size=args.correction_batch_size,
+    )
+    logger.info(f"Answering {len(questions)} questions.")
+    results = run_batch(conversation, questions, args.concurrency)
+    write_results(results, args.out)
+
+    failed = sum(1 for r in results if r["error"])
+    tokens = sum(r["total_tokens"] for r in results)
+    logger.info(
+        f"Wrote {len(results)} answers to {args.out} ({failed} failed, "
+        f"{tokens} tokens)."
+    )
+
+
+if __name__ == "__main__":
+    main()
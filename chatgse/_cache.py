@@ -0,0 +1,185 @@
+# ChatGSE response cache
+# reuse model responses for identical conversations across sessions
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    namespace TEXT,
+    response TEXT,
+    token_usage TEXT,
+    created REAL,
+    accessed REAL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+
+class ResponseCache:
+    """
+    Process-wide SQLite cache of model responses. Entries are keyed on a hash
+    of everything that determines the response (see `key`), so sessions
+    that run the same conversation, e.g. the same demo with the same tool
+    file, share the response. Entries expire after a time to live, and the
+    least recently used entries are evicted once the cache is full.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = None,
+        ttl: float = None,
+    ):
+        """
+        Args:
+            path: location of the SQLite database file
+
+            max_entries: maximum number of cached responses (env:
+                CHATGSE_CACHE_SIZE, default 10000)
+
+            ttl: seconds after which a response expires (env:
+                CHATGSE_CACHE_TTL, default one day); 0 disables the cache
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries or int(
+            os.getenv("CHATGSE_CACHE_SIZE", 10000)
+        )
+        self.ttl = ttl
+        if self.ttl is None:
+            self.ttl = float(os.getenv("CHATGSE_CACHE_TTL", 86400))
+        self.hits = {}
+        self.misses = {}
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @staticmethod
+    def key(namespace: str, model: str, prompts, messages: list, text=None):
+        """
+        Build the cache key of a request.
+
+        Args:
+            namespace: kind of request, e.g. "response" or "correction"
+
+            model: name of the model answering the request
+
+            prompts: the prompt set of the conversation
+
+            messages: the langchain messages sent to the model
+
+            text: the input, if it is not part of the messages
+
+        Returns:
+            str: hex digest identifying the request
+        """
+        payload = json.dumps(
+            [
+                namespace,
+                model,
+                prompts,
+                [(m.type, m.content) for m in messages],
+                text,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str, namespace: str = "response"):
+        """
+        Look up a response and mark it as recently used.
+
+        Returns:
+            tuple: the response and its original token usage, or None
+        """
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, token_usage FROM responses "
+                "WHERE key = ? AND created > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                self.misses[namespace] = self.misses.get(namespace, 0) + 1
+                return None
+
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits[namespace] = self.hits.get(namespace, 0) + 1
+
+        response, token_usage = row
+        return json.loads(response), json.loads(token_usage)
+
+    def put(
+        self,
+        key: str,
+        response,
+        token_usage: dict,
+        namespace: str = "response",
+    ):
+        """
+        Store a response, evicting expired and least recently used entries.
+        """
+        if not self.enabled:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    namespace,
+                    json.dumps(response),
+                    json.dumps(token_usage),
+                    now,
+                    now,
+                ),
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE created <= ?", (now - self.ttl,)
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def metrics(self):
+        """
+        Returns:
+            dict: number of entries, and hits and misses per namespace
+        """
+        with self._lock:
+            (entries,) = self._conn.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()
+            return {
+                "entries": entries,
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+            }
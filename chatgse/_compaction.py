@@ -0,0 +1,131 @@
+# ChatGSE conversation compaction
+# keep the prompt within a token budget by dropping the oldest turns
+
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
+from chatgse._tokens import count_message_tokens
+
+COMPACTION_PREFIX = (
+    "To save space, earlier parts of the conversation were removed. In these, "
+    "the user asked: "
+)
+
+# number of characters of each removed question that is kept in the summary
+QUESTION_CHARS = 200
+
+# maximum length of the summary; the oldest questions are cut first
+SUMMARY_CHARS = 2000
+
+
+def chat_start(messages: list):
+    """
+    Find where the chat starts: at the first user message that is answered,
+    i.e. followed by a model message before the next user message. User
+    messages before it, such as the description of the tool data, belong to
+    the setup of the conversation.
+
+    Returns:
+        int: index of the first question, or the number of messages if none
+            was answered yet
+    """
+    question = None
+    for i, m in enumerate(messages):
+        if isinstance(m, HumanMessage):
+            question = i
+        elif isinstance(m, AIMessage) and question is not None:
+            return question
+    return len(messages)
+
+
+def compact_messages(
+    messages: list,
+    budget: int,
+    model: str = None,
+    reserve: int = 0,
+    prefixes: tuple = (),
+):
+    """
+    Shorten a conversation to fit a token budget. System messages (the
+    prompts, injected context, and tool data) and the setup before the first
+    question (see `chat_start`) count against the budget, but are always
+    kept. The oldest exchanges between user and model are removed
+    until the prompt fits, and the questions of the removed exchanges are
+    kept in a short system message. The most recent exchange is never
+    removed, so the result can still exceed the budget, e.g. if the system
+    messages alone do; the caller has to block or trim the request then.
+
+    Args:
+        messages: langchain messages of the conversation
+
+        budget: maximum number of prompt tokens
+
+        model: the model the messages are meant for
+
+        reserve: tokens to keep free for the upcoming user message
+
+        prefixes: shared prompt prefixes of the conversation, whose tokens
+            are counted once (see `chatgse._prompts`)
+
+    Returns:
+        tuple: the compacted messages, the number of tokens saved, and the
+            number of tokens by which the result still exceeds the budget
+            (0 if it fits)
+    """
+    before = count_message_tokens(messages, model, prefixes) + reserve
+    if before <= budget:
+        return messages, 0, 0
+
+    # exchanges start with a user message and hold the answers to it
+    exchanges = []
+    for i in range(chat_start(messages), len(messages)):
+        m = messages[i]
+        if isinstance(m, HumanMessage):
+            exchanges.append([i])
+        elif isinstance(m, AIMessage) and exchanges:
+            exchanges[-1].append(i)
+
+    summary = None
+    questions = []
+    removed = set()
+    for m in messages:
+        if isinstance(m, SystemMessage) and m.content.startswith(
+            COMPACTION_PREFIX
+        ):
+            summary = m
+            questions.append(m.content[len(COMPACTION_PREFIX) :].rstrip("."))
+
+    compacted = messages
+    for exchange in exchanges[:-1]:
+        question = messages[exchange[0]].content
+        if len(question) > QUESTION_CHARS:
+            question = question[:QUESTION_CHARS] + " ..."
+        questions.append(f"'{question}'")
+        removed.update(exchange)
+
+        compacted = _rebuild(messages, removed, summary, questions)
+        tokens = count_message_tokens(compacted, model, prefixes)
+        if tokens + reserve <= budget:
+            break
+
+    after = count_message_tokens(compacted, model, prefixes) + reserve
+    return compacted, max(before - after, 0), max(after - budget, 0)
+
+
+def _rebuild(messages: list, removed: set, summary, questions: list):
+    """
+    Rebuild the message list without the removed messages, with the summary
+    of removed questions in place of the first removed message.
+    """
+    body = "; ".join(questions)
+    if len(body) > SUMMARY_CHARS:
+        body = "... " + body[-SUMMARY_CHARS:]
+    new_summary = SystemMessage(content=COMPACTION_PREFIX + body + ".")
+    first = min(removed)
+    compacted = []
+    for i, m in enumerate(messages):
+        if i == first:
+            compacted.append(new_summary)
+        if i in removed or m is summary:
+            continue
+        compacted.append(m)
+    return compacted
@@ -0,0 +1,265 @@
+# ChatGSE correction
+# check responses with the correcting agent, sentences in parallel
+
+import functools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import nltk
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import HumanMessage, SystemMessage
+from loguru import logger
+from nltk.tokenize.punkt import PunktSentenceTokenizer
+
+from chatgse._llm import QueryCancelled
+from chatgse._scheduler import request_slot
+
+# sentence corrections run here, across all sessions; bounds the number of
+# concurrent requests to the correcting agent
+SENTENCE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CHATGSE_SENTENCE_WORKERS", 8)),
+    thread_name_prefix="chatgse-sentence",
+)
+
+# sentences checked per request to the correcting agent
+BATCH_SIZE = int(os.getenv("CHATGSE_CORRECTION_BATCH_SIZE", 5))
+
+BATCH_INSTRUCTION = (
+    "You will be given numbered statements. Check each of them, and respond "
+    "with only a JSON list holding one object per statement, with the keys "
+    '"sentence" (the number of the statement) and "correction" (your '
+    'correction of the statement, or "OK" if there is nothing to correct). '
+    'For example: [{"sentence": 1, "correction": "OK"}].'
+)
+
+
+@functools.lru_cache(maxsize=None)
+def sentence_tokenizer():
+    """
+    The punkt sentence tokeniser, loaded once per process and downloaded
+    only if it is missing. If it cannot be downloaded, an untrained punkt
+    tokeniser is used, which does not know abbreviations.
+    """
+    try:
+        return nltk.data.load("tokenizers/punkt/english.pickle")
+    except LookupError:
+        nltk.download("punkt", quiet=True)
+    try:
+        return nltk.data.load("tokenizers/punkt/english.pickle")
+    except LookupError:
+        logger.warning("punkt not available, using an untrained tokeniser.")
+        return PunktSentenceTokenizer()
+
+
+def is_ok(correction):
+    return str(correction).lower() in ["ok", "ok."]
+
+
+def correct_query(
+    conversation,
+    msg: str,
+    parallel: bool = True,
+    batch_size: int = None,
+    scheduler=None,
+    session: str = None,
+    cancel=None,
+):
+    """
+    Check a response with the correcting agent of a conversation, as
+    `Conversation._correct_query` does. With `split_correction`, the
+    sentences of the response are checked in batches of numbered sentences,
+    one request per batch (see `correct_batch`), and the batches are sent
+    concurrently on the `SENTENCE_EXECUTOR`; the corrections keep the order
+    of the sentences.
+
+    Args:
+        conversation: the conversation whose correcting agent to use
+
+        msg: the response to check
+
+        parallel: check the batches concurrently; if False, one after the
+            other
+
+        batch_size: sentences per request (default: the
+            `correction_batch_size` of the conversation, or
+            CHATGSE_CORRECTION_BATCH_SIZE, 5); 1 checks each sentence on its
+            own, as biochatter does
+
+        scheduler: the `RequestScheduler` of the community key; each request
+            waits for its own slot
+
+        session: the session sending the requests
+
+        cancel: optional `threading.Event`; once it is set, no further
+            requests are sent
+
+    Returns:
+        list: the corrections; empty if there is nothing to correct
+
+    Raises:
+        openai.error.OpenAIError: the error of the first failed request
+
+        QueryCancelled: the correction was cancelled
+    """
+    if not conversation.split_correction:
+        correction = check_sentence(
+            conversation, msg, scheduler, session, cancel
+        )
+        return [] if is_ok(correction) else [correction]
+
+    if batch_size is None:
+        batch_size = getattr(
+            conversation, "correction_batch_size", BATCH_SIZE
+        )
+    batch_size = max(int(batch_size), 1)
+
+    sentences = sentence_tokenizer().tokenize(msg)
+    batches = [
+        sentences[i : i + batch_size]
+        for i in range(0, len(sentences), batch_size)
+    ]
+
+    def check(batch: list):
+        if len(batch) == 1:
+            return [
+                check_sentence(
+                    conversation, batch[0], scheduler, session, cancel
+                )
+            ]
+        return correct_batch(conversation, batch, scheduler, session, cancel)
+
+    if parallel and len(batches) > 1:
+        results = SENTENCE_EXECUTOR.map(check, batches)
+    else:
+        results = map(check, batches)
+
+    return [c for result in results for c in result if not is_ok(c)]
+
+
+def check_sentence(
+    conversation, msg: str, scheduler=None, session=None, cancel=None
+):
+    """
+    Check one sentence, or a whole response, in one request to the
+    correcting agent, as `Conversation._correct_response` does.
+
+    Returns:
+        str: the correction, or "OK"
+    """
+    _check_cancel(cancel)
+    messages = list(conversation.ca_messages) + [HumanMessage(content=msg)]
+    with request_slot(
+        scheduler,
+        conversation,
+        session,
+        messages,
+        model=getattr(conversation, "ca_model_name", None),
+    ):
+        return conversation._correct_response(msg)
+
+
+def correct_batch(
+    conversation, sentences: list, scheduler=None, session=None, cancel=None
+):
+    """
+    Check several sentences in one request to the correcting agent, which
+    answers with a JSON verdict per numbered sentence. The correcting prompts
+    are sent once for the batch instead of once per sentence. Sentences
+    without a valid verdict, or all of them if the agent cannot be called
+    directly, are checked one by one. Each request waits for its own slot
+    of the scheduler.
+
+    Returns:
+        list: the correction of each sentence, or "OK"
+    """
+    # one statement per line; sentences spanning lines, e.g. in markdown
+    # lists, would shift the numbering
+    numbered = "\n".join(
+        f"{i + 1}. {' '.join(s.split())}" for i, s in enumerate(sentences)
+    )
+    messages = list(conversation.ca_messages) + [
+        SystemMessage(content=BATCH_INSTRUCTION),
+        HumanMessage(content=numbered),
+    ]
+
+    _check_cancel(cancel)
+    verdicts = {}
+    with request_slot(
+        scheduler,
+        conversation,
+        session,
+        messages,
+        model=getattr(conversation, "ca_model_name", None),
+    ):
+        text = _complete_correction(conversation, messages)
+    if text is not None:
+        verdicts = parse_verdicts(text, len(sentences))
+        if len(verdicts) < len(sentences):
+            logger.warning(
+                f"No verdict for {len(sentences) - len(verdicts)} of "
+                f"{len(sentences)} sentences, checking them one by one."
+            )
+
+    return [
+        verdicts[i]
+        if i in verdicts
+        else check_sentence(conversation, s, scheduler, session, cancel)
+        for i, s in enumerate(sentences)
+    ]
+
+
+def parse_verdicts(text: str, n: int):
+    """
+    Read the verdicts of a batch from the answer of the correcting agent.
+
+    Returns:
+        dict: the correction (or "OK") by index of the sentence, for the
+            sentences with a valid verdict
+    """
+    try:
+        items = json.loads(text[text.index("[") : text.rindex("]") + 1])
+    except ValueError:
+        return {}
+
+    verdicts = {}
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        number = item.get("sentence")
+        correction = item.get("correction")
+        if (
+            isinstance(number, int)
+            and 1 <= number <= n
+            and isinstance(correction, str)
+            and correction.strip()
+        ):
+            verdicts[number - 1] = correction.strip()
+    return verdicts
+
+
+def _check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise QueryCancelled("cancelled")
+
+
+def _complete_correction(conversation, messages: list):
+    """
+    Send messages to the correcting agent of a conversation, counting the
+    usage as `_correct_response` does.
+
+    Returns:
+        str: the answer, or None if the agent cannot be called directly
+    """
+    if hasattr(conversation, "complete_correction"):
+        return conversation.complete_correction(messages)
+
+    chat = getattr(conversation, "ca_chat", None)
+    if not isinstance(chat, ChatOpenAI):
+        return None
+
+    response = chat.generate([messages])
+    conversation._update_usage_stats(
+        conversation.ca_model_name, response.llm_output.get("token_usage")
+    )
+    return response.generations[0][0].text
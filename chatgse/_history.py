@@ -0,0 +1,148 @@
+# ChatGSE message log
+# compact, append-only storage of the displayed conversation
+
+import json
+import sys
+
+
+class MessageLog:
+    """
+    Append-only log of (role, message) pairs, stored column-wise. Roles are
+    interned, so a role costs one pointer per message regardless of how often
+    it appears, and there is no per-message container object as in the
+    previous list of single-key dicts.
+
+    The `version` counter is increased on every change. The JSON export is
+    cached against it and extended with new messages only, so repeated
+    exports of an unchanged log are free. Messages resolved at export, e.g.
+    table references, are encoded anew on each export and never kept.
+    """
+
+    __slots__ = (
+        "_roles",
+        "_msgs",
+        "version",
+        "_json_parts",
+        "_json",
+        "_json_version",
+    )
+
+    def __init__(self, messages: list = None):
+        """
+        Args:
+            messages: optional iterable of (role, message) pairs to start with
+        """
+        self._roles = []
+        self._msgs = []
+        self.version = 0
+        self._json_parts = []
+        self._json = "[]"
+        self._json_version = 0
+        for role, msg in messages or []:
+            self.append(role, msg)
+
+    def append(self, role: str, msg: str):
+        self._roles.append(sys.intern(role))
+        self._msgs.append(msg)
+        self.version += 1
+
+    def clear(self):
+        self._roles.clear()
+        self._msgs.clear()
+        self._json_parts.clear()
+        self.version += 1
+
+    def __len__(self):
+        return len(self._msgs)
+
+    def __bool__(self):
+        return bool(self._msgs)
+
+    def __iter__(self):
+        return zip(self._roles, self._msgs)
+
+    def __getitem__(self, i: int):
+        return self._roles[i], self._msgs[i]
+
+    def blocks(self, render, start: int = 0, stop: int = None, alone=None):
+        """
+        Render a range of the log as markdown, joining consecutive messages
+        into one block, so that the log is written with a few page elements
+        however long it is. Nothing is kept between calls.
+
+        Args:
+            render: function mapping (role, message) to markdown
+
+            start: index of the first message
+
+            stop: index after the last message (default: the end of the log)
+
+            alone: optional function telling from (role, message) whether a
+                message is shown on its own instead, e.g. as a table
+
+        Yields:
+            tuple: the index of the first message of a block and its
+                markdown, or the index of a message shown on its own and None
+        """
+        stop = len(self._msgs) if stop is None else min(stop, len(self._msgs))
+        first, parts = start, []
+        for i in range(start, stop):
+            role, msg = self._roles[i], self._msgs[i]
+            if alone and alone(role, msg):
+                if parts:
+                    yield first, "\n\n".join(parts)
+                    parts = []
+                yield i, None
+                first = i + 1
+            else:
+                parts.append(render(role, msg))
+        if parts:
+            yield first, "\n\n".join(parts)
+
+    def to_list(self):
+        """
+        Returns:
+            list: the messages in the legacy `[{role: message}, ...]` format
+        """
+        return [{role: msg} for role, msg in self]
+
+    def to_json(self, resolve=None):
+        """
+        Serialise the log to JSON in the legacy `[{role: message}, ...]`
+        format (identical to `json.dumps(self.to_list())`). Only messages
+        appended since the last call are encoded; resolved messages are
+        encoded on every call, and the result is then not cached.
+
+        Args:
+            resolve: optional function mapping (role, message) to the content
+                that is written for the message, e.g. to resolve references,
+                or to None if the message is written as it is
+
+        Returns:
+            str: the JSON representation of the log
+        """
+        parts = self._json_parts
+        if self._json_version != self.version:
+            for i in range(len(parts), len(self._msgs)):
+                role, msg = self._roles[i], self._msgs[i]
+                if resolve and resolve(role, msg) is not None:
+                    # keep only the index; the content may be large
+                    parts.append(None)
+                else:
+                    parts.append(json.dumps({role: msg}))
+            self._json = None
+            self._json_version = self.version
+        if self._json is not None:
+            return self._json
+
+        encoded = []
+        for i, part in enumerate(parts):
+            if part is None:
+                role, msg = self._roles[i], self._msgs[i]
+                content = resolve(role, msg) if resolve else None
+                part = json.dumps({role: msg if content is None else content})
+            encoded.append(part)
+        text = "[" + ", ".join(encoded) + "]"
+        if None not in parts:
+            self._json = text
+        return text
@@ -0,0 +1,151 @@
+# ChatGSE HTTP clients
+# share keep-alive connections to the model APIs across sessions
+
+import hashlib
+import os
+import threading
+from urllib.parse import urlsplit
+
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+# connections kept open per endpoint and credential; as many as requests can
+# run at once (see `chatgse._llm.REQUEST_EXECUTOR`)
+POOL_SIZE = int(os.getenv("CHATGSE_HTTP_POOL_SIZE", 32))
+
+
+def credentials(chat) -> dict:
+    """
+    The request arguments that bind the calls of a langchain chat model to
+    its own key and endpoint. langchain and biochatter set the key of the
+    last session on the global `openai` module; without these arguments,
+    concurrent sessions would send each other's keys.
+
+    Returns:
+        dict: arguments of `openai.ChatCompletion.create`
+    """
+    kwargs = {}
+    if getattr(chat, "openai_api_key", None):
+        kwargs["api_key"] = chat.openai_api_key
+    if getattr(chat, "openai_api_base", None):
+        kwargs["api_base"] = chat.openai_api_base
+        kwargs["api_type"] = chat.openai_api_type
+        kwargs["api_version"] = chat.openai_api_version
+    return kwargs
+
+
+def bind_credentials(conversation):
+    """
+    Make the chat models of a conversation send their own key and endpoint
+    with each request (see `credentials`).
+    """
+    for name in ["chat", "ca_chat"]:
+        chat = getattr(conversation, name, None)
+        if chat is not None and hasattr(chat, "model_kwargs"):
+            chat.model_kwargs = {**chat.model_kwargs, **credentials(chat)}
+
+
+class ClientPool:
+    """
+    Process-wide HTTP sessions, one per endpoint and credential, shared by
+    all user sessions. Each keeps up to `POOL_SIZE` connections alive, so
+    that requests reuse open (TLS) connections instead of connecting anew.
+
+    openai keeps a session per thread and replaces it every few minutes;
+    Streamlit runs each script run in a new thread, so most requests would
+    otherwise connect anew. `install` makes openai send all requests through
+    the pool.
+    """
+
+    def __init__(self, size: int = None):
+        self.size = size or POOL_SIZE
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url: str, headers: dict):
+        """
+        The endpoint of a request and a hash of its credential, which is not
+        kept in memory in the clear.
+        """
+        parts = urlsplit(url)
+        credential = ""
+        for name, value in (headers or {}).items():
+            if name.lower() in ["authorization", "api-key"]:
+                credential = value
+        digest = hashlib.sha256(credential.encode()).hexdigest()[:16]
+        return f"{parts.scheme}://{parts.netloc}", digest
+
+    def session(self, endpoint: str, credential: str):
+        with self._lock:
+            if (endpoint, credential) not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.size,
+                    max_retries=openai.api_requestor.MAX_CONNECTION_RETRIES,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[(endpoint, credential)] = session
+            return self._sessions[(endpoint, credential)]
+
+    def request(self, method: str, url: str, **kwargs):
+        session = self.session(*self.key(url, kwargs.get("headers")))
+        return session.request(method, url, **kwargs)
+
+    def install(self):
+        """
+        Send the requests of the openai module through the pool.
+        """
+        openai.requestssession = PooledSession(self)
+
+    def metrics(self):
+        """
+        Returns:
+            list: per endpoint and credential, the number of requests, of
+                connections opened, and of TLS handshakes
+        """
+        with self._lock:
+            sessions = list(self._sessions.items())
+
+        rows = []
+        for (endpoint, credential), session in sessions:
+            row = {
+                "endpoint": endpoint,
+                "credential": credential[:8],
+                "requests": 0,
+                "connections": 0,
+                "handshakes": 0,
+            }
+            adapter = session.get_adapter(endpoint)
+            manager = adapter.poolmanager
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                row["requests"] += pool.num_requests
+                row["connections"] += pool.num_connections
+                if pool.scheme == "https":
+                    row["handshakes"] += pool.num_connections
+            rows.append(row)
+        return rows
+
+
+class PooledSession(requests.Session):
+    """
+    Stand-in for the session of the openai module that passes each request
+    on to the session of its endpoint and credential in a `ClientPool`.
+    """
+
+    def __init__(self, pool: ClientPool):
+        super().__init__()
+        self.pool = pool
+
+    def request(self, method, url, **kwargs):
+        return self.pool.request(method, url, **kwargs)
+
+    def close(self):
+        # openai closes its sessions regularly; the pooled connections stay
+        pass
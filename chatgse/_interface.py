@@ -1,11 +1,35 @@
 # ChatGSE user interface class
 # manage the different roles / stages of conversation
 
+import functools
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_for
 from loguru import logger
 import pandas as pd
 import streamlit as st
+from langchain.schema import HumanMessage, SystemMessage
+from chatgse._history import MessageLog
+from chatgse._tables import TableStore
+from chatgse._compaction import chat_start, compact_messages
+from chatgse._correction import correct_query
+from chatgse._http import bind_credentials
+from chatgse._prompts import apply_prompts, share_prompts
+from chatgse._tokens import count_message_tokens, count_tokens
+from chatgse._llm import (
+    QUERY_DEADLINE,
+    QueryCancelled,
+    record_usage,
+    resilient_completion,
+    supports_completion,
+)
+from chatgse._mock import MockConversation, MOCK_MODELS, MOCK_TOKEN_LIMITS
+from chatgse._router import route, router_limit, router_models
+from chatgse._scheduler import COMPLETION_ESTIMATE, request_slot
+from chatgse._session_store import RETENTION_DAYS, SessionStore
 from biochatter.llm_connect import (
     GptConversation,
     AzureGptConversation,
@@ -53,6 +77,88 @@ PLEASE_ENTER_QUESTIONS = (
     "more questions."
 )
 
+# roles that answer the user; every other role in the history opens a new turn
+AGENT_ROLES = ["📎 Assistant", "💬🧬 ChatGSE", "🕵️ Correcting agent", "tool"]
+
+# roles of the message types in the export of the complete history, as in
+# `Conversation.get_msg_json`
+EXPORT_ROLES = {"system": "system", "human": "user", "ai": "ai"}
+
+# share of the model's token limit above which the conversation is compacted
+COMPACTION_FRACTION = float(os.getenv("CHATGSE_COMPACTION_FRACTION", 0.75))
+
+# corrections run in the background, shared by all sessions of the process
+CORRECTION_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CHATGSE_CORRECTION_WORKERS", 8)),
+    thread_name_prefix="chatgse-correction",
+)
+
+# session state entries persisted alongside history, messages, and tables
+PERSISTED_STATE = [
+    "primary_model",
+    "conversation_mode",
+    "user",
+    "token_usage",
+    "read_tools",
+    "started_tool_input",
+    "asked_for_name",
+    "show_intro",
+    "show_setup",
+    "show_community_select",
+    "key_fingerprint",
+]
+
+
+def _correct(
+    conversation,
+    msg: str,
+    cache=None,
+    scheduler=None,
+    session=None,
+    cancel=None,
+):
+    """
+    Have the correcting agent of a conversation check a response, reusing
+    cached corrections of identical responses. On the community key, each
+    request of the correction waits for its own slot of the scheduler.
+
+    Returns:
+        list: the corrections; empty if there is nothing to correct
+    """
+    if not cache:
+        return correct_query(
+            conversation,
+            msg,
+            scheduler=scheduler,
+            session=session,
+            cancel=cancel,
+        )
+
+    key = cache.key(
+        "correction",
+        conversation.ca_model_name,
+        conversation.prompts,
+        conversation.ca_messages,
+        [
+            msg,
+            conversation.split_correction,
+            getattr(conversation, "correction_batch_size", None),
+        ],
+    )
+    cached = cache.get(key, namespace="correction")
+    if cached:
+        return cached[0]
+
+    corrections = correct_query(
+        conversation,
+        msg,
+        scheduler=scheduler,
+        session=session,
+        cancel=cancel,
+    )
+    cache.put(key, corrections, {}, namespace="correction")
+    return corrections
+
 
 class ChatGSE:
     def __init__(self):
@@ -60,69 +166,183 @@ class ChatGSE:
             ss.input = ""
 
         if "history" not in ss:
-            ss.history = []
+            ss.history = MessageLog()
 
         if "setup_messages" not in ss:
-            ss.setup_messages = []
+            ss.setup_messages = MessageLog()
+
+        if "opened_turns" not in ss:
+            ss.opened_turns = set()
+
+        if "tables" not in ss:
+            ss.tables = TableStore()
 
     def _display_setup(self):
         """
         Renders setup messages on each reload. Conditionally shown only at setup
         stage.
         """
-        for item in ss.setup_messages:
-            for role, msg in item.items():
-                st.markdown(self._render_msg(role, msg))
+        for role, msg in ss.setup_messages:
+            st.markdown(self._render_msg(role, msg))
 
-    def _display_history(self):
+    def _display_history(self, window: int = 0):
         """
-        Renders the history of the conversation on each reload. Also saves a
-        JSON to the session state for download.
+        Renders the history of the conversation on each reload. Consecutive
+        messages are joined into one markdown block (see `MessageLog.blocks`),
+        so the page gets a few elements however long the history is; only
+        tables are shown on their own.
+
+        Args:
+            window: number of most recent turns to render fully. Older turns
+                are collapsed into expanders whose messages are only rendered
+                once the user asks for them. 0 renders the full history.
         """
-        for item in ss.history:
-            for role, msg in item.items():
-                if role == "tool":
-                    st.markdown(
-                        f"""
-                        ```
-                        {msg}
-                        """
-                    )
+        if not window:
+            self._display_entries(0, len(ss.history))
+            return
+
+        turns = self._history_turns()
+        older = max(len(turns) - window, 0)
+
+        for n, turn in enumerate(turns[:older]):
+            first_role, first_msg = ss.history[turn[0]]
+            label = " ".join(self._render_msg(first_role, first_msg).split())
+            if len(label) > 80:
+                label = label[:77] + "..."
+
+            with st.expander(label):
+                if n in ss.opened_turns:
+                    self._display_entries(turn[0], turn[-1] + 1)
                 else:
-                    st.markdown(self._render_msg(role, msg))
+                    st.button(
+                        f"Show {len(turn)} messages",
+                        key=f"open_turn_{n}",
+                        on_click=self._open_turn,
+                        args=(n,),
+                    )
+
+        if older < len(turns):
+            self._display_entries(turns[older][0], len(ss.history))
+
+    def _display_entries(self, start: int, stop: int):
+        for i, block in ss.history.blocks(
+            self._render_entry, start, stop, alone=self._is_table
+        ):
+            if block is None:
+                st.dataframe(ss.tables.get(ss.history[i][1]))
+            else:
+                st.markdown(block)
+
+    @staticmethod
+    def _is_table(role: str, msg: str):
+        # tool entries reference a table in the session's table store
+        return role == "tool" and msg in ss.tables
+
+    def _history_turns(self):
+        """
+        Group the history into turns. A turn starts with a message from the
+        user and contains all following agent messages.
 
-    def update_json_history(self):
+        Returns:
+            list: one list of ss.history indices per turn
         """
-        Write ss.history to JSON and put it into session state.
+        turns = []
+        for i, (role, _) in enumerate(ss.history):
+            if not turns or role not in AGENT_ROLES:
+                turns.append([])
+            turns[-1].append(i)
+        return turns
+
+    @staticmethod
+    def _open_turn(n: int):
+        ss.opened_turns.add(n)
+
+    def chat_history_json(self):
         """
-        ss.json_history = json.dumps(ss.history)
+        The history as JSON. The message log caches the JSON of its text
+        messages, so this only encodes new messages; tables are rendered to
+        markdown on each call and not kept.
+
+        Returns:
+            str: the JSON representation of the history
+        """
+        return ss.history.to_json(resolve=self._export_msg)
+
+    @staticmethod
+    def _export_msg(role: str, msg: str):
+        """
+        Resolve table references of tool entries to their markdown for export.
+        """
+        if role == "tool" and msg in ss.tables:
+            return ss.tables.to_markdown(msg)
+        return None
 
     def complete_history(self):
         """
-        Write ss.messages to JSON and put it into session state.
+        The conversation messages, including the system prompts, as JSON in
+        the format of `Conversation.get_msg_json`. The messages are mirrored
+        in a `MessageLog` (`ss.complete_history`), which only encodes the
+        messages added since the last call; if earlier messages changed, e.g.
+        by compaction, the log is built again.
+
+        Returns:
+            str: the JSON representation of the messages
+        """
+        messages = ss.conversation.messages
+        log = ss.get("complete_history")
+        sources = ss.get("complete_history_sources", [])
+        kept = 0
+        for mirrored, message in zip(sources, messages):
+            if mirrored is not message:
+                break
+            kept += 1
+        if log is None or kept < len(sources):
+            log, sources, kept = MessageLog(), [], 0
+
+        for message in messages[kept:]:
+            log.append(EXPORT_ROLES[message.type], message.content)
+            sources.append(message)
+        ss.complete_history = log
+        ss.complete_history_sources = sources
+        return log.to_json()
+
+    def has_complete_history(self):
+        """
+        Cheap check whether there are any conversation messages to export,
+        without serialising them.
         """
-        return ss.conversation.get_msg_json()
+        return bool(ss.get("conversation") and ss.conversation.messages)
 
     @staticmethod
     def _render_msg(role: str, msg: str):
         return f"`{role}`: {msg}"
 
+    @staticmethod
+    def _render_tool(msg: str):
+        return f"```\n{msg}\n```"
+
+    def _render_entry(self, role: str, msg: str):
+        if role == "tool":
+            return self._render_tool(msg)
+        return self._render_msg(role, msg)
+
     def _history_only(self, role: str, msg: str):
-        ss.history.append({role: msg})
+        ss.history.append(role, msg)
 
     def _setup_only(self, role: str, msg: str):
         # only keep the most recent setup message
-        ss.setup_messages = [{role: msg}]
+        ss.setup_messages.clear()
+        ss.setup_messages.append(role, msg)
 
     def _write_and_history(self, role: str, msg: str):
         logger.info(f"Writing message from {role}: {msg}")
         st.markdown(self._render_msg(role, msg))
-        ss.history.append({role: msg})
+        ss.history.append(role, msg)
 
     def _write_and_setup(self, role: str, msg: str):
         logger.info(f"Writing message from {role}: {msg}")
         st.markdown(self._render_msg(role, msg))
-        ss.setup_messages.append({role: msg})
+        ss.setup_messages.append(role, msg)
 
     def set_model(self, model_name: str):
         """
@@ -156,6 +376,146 @@ class ChatGSE:
                 split_correction=ss.split_correction,
                 docsum=ss.get("docsum"),
             )
+        elif model_name in MOCK_MODELS:
+            ss.conversation = MockConversation(
+                model_name=model_name,
+                prompts=ss.prompts,
+                split_correction=ss.split_correction,
+                docsum=ss.get("docsum"),
+            )
+
+    def save_session(self, store):
+        """
+        Queue the changes to the session since the last call for persistence
+        in the session store. Only new history entries, conversation messages
+        and tables are written; mode, prompts and the remaining state are
+        rewritten only when they changed.
+
+        Args:
+            store: the SessionStore to persist to
+        """
+        if ss.get("pending_restore"):
+            # nothing is written until the session is resumed or discarded
+            return
+
+        token = ss.session_token
+        if "persisted" not in ss:
+            ss.persisted = {
+                "session": None,
+                "history": 0,
+                "messages": (0, None),
+                "ca_messages": (0, None),
+                "tables": set(),
+            }
+        persisted = ss.persisted
+        ops = []
+
+        conversation = ss.get("conversation")
+        state = {key: ss.get(key) for key in PERSISTED_STATE}
+        state["user_name"] = getattr(conversation, "user_name", None)
+        state["context"] = getattr(conversation, "context", None)
+        session = (ss.get("mode"), ss.get("prompts"), state)
+        serialised = json.dumps(session, sort_keys=True, default=str)
+        if serialised != persisted["session"]:
+            ops.append(store.session_op(token, *session))
+            persisted["session"] = serialised
+
+        n = persisted["history"]
+        if n > len(ss.history):
+            ops.append(store.truncate_history_op(token, 0))
+            n = 0
+        for i in range(n, len(ss.history)):
+            ops.append(store.history_op(token, i, *ss.history[i]))
+        persisted["history"] = len(ss.history)
+
+        if conversation:
+            for agent in ["messages", "ca_messages"]:
+                messages = getattr(conversation, agent)
+                n, last = persisted[agent]
+                # rewrite if earlier messages were changed or removed
+                if n > len(messages) or (n and id(messages[n - 1]) != last):
+                    ops.append(store.truncate_messages_op(token, agent, 0))
+                    n = 0
+                for i in range(n, len(messages)):
+                    ops.append(store.message_op(token, agent, i, messages[i]))
+                persisted[agent] = (
+                    len(messages),
+                    id(messages[-1]) if messages else None,
+                )
+
+        for ref in ss.tables:
+            if ref not in persisted["tables"]:
+                ops.append(store.table_op(token, ref, ss.tables.get(ref)))
+                persisted["tables"].add(ref)
+
+        store.put(ops, token)
+
+    def restore_session(self, token: str, session: dict):
+        """
+        Hold a persisted session until it can be resumed. Only the model is
+        set right away; history, tables and conversation are restored by
+        `_resume_session` once an API key of the same kind as the original
+        one (the same key, or the community key for community sessions) is
+        accepted. The token alone grants neither a key nor the contents.
+
+        Args:
+            token: the token of the persisted session
+
+            session: a session as returned by SessionStore.load
+        """
+        model = session["state"].get("primary_model")
+        if model:
+            ss.primary_model = model
+        ss.pending_restore = (token, session)
+
+    def _resume_session(self, key: str):
+        """
+        Resume a held session if the accepted API key matches the one it was
+        created with; otherwise, discard it and keep the new session.
+
+        Returns:
+            bool: whether a session was resumed
+        """
+        if not ss.get("pending_restore"):
+            return False
+        token, session = ss.pop("pending_restore")
+        state = session["state"]
+
+        if state.get("key_fingerprint") != SessionStore.fingerprint(
+            key
+        ) or state.get("user") != ss.get("user"):
+            logger.info("API key does not match the session, not restoring.")
+            st.experimental_set_query_params(session=ss.session_token)
+            return False
+
+        logger.info("Resuming session.")
+        ss.session_token = token
+        ss.pop("persisted", None)
+        if session["prompts"]:
+            ss.prompts = session["prompts"]
+            ss.conversation.prompts = ss.prompts
+
+        for name in PERSISTED_STATE:
+            if state.get(name) is not None:
+                ss[name] = state[name]
+
+        ss.history = MessageLog(session["history"])
+        ss.tables = TableStore()
+        for ref, df in session["tables"].items():
+            ss.tables.add(ref, df)
+
+        conversation = ss.conversation
+        conversation.messages = session["messages"]
+        conversation.ca_messages = session["ca_messages"]
+        share_prompts(conversation)
+        if state.get("user_name"):
+            conversation.set_user_name(state["user_name"])
+        if state.get("context"):
+            conversation.context = state["context"]
+
+        if session["mode"]:
+            ss.restored_mode = session["mode"]
+        return True
 
     def _check_for_api_key(self, write: bool = True, input: str = None):
         """
@@ -173,8 +533,13 @@ class ChatGSE:
             key = ss.get("openai_api_key")
         elif ss.primary_model in HUGGINGFACE_MODELS:
             key = ss.get("huggingfacehub_api_key")
+        elif ss.primary_model in MOCK_MODELS:
+            # the mock backend needs no key
+            key = "mock"
 
-        ss.token_limit = TOKEN_LIMITS[ss.primary_model]
+        ss.token_limit = {**TOKEN_LIMITS, **MOCK_TOKEN_LIMITS}[
+            ss.primary_model
+        ]
 
         if not key and input:
             key = input
@@ -257,9 +622,15 @@ class ChatGSE:
         if not success:
             return False
 
+        # requests go through the shared client pool with this session's key
+        bind_credentials(ss.conversation)
+
         if ss.primary_model in OPENAI_MODELS:
             ss.openai_api_key = key
 
+        self._resume_session(key)
+        ss.key_fingerprint = SessionStore.fingerprint(key)
+
         return True
 
     def _get_api_key(self, key: str = None):
@@ -327,7 +698,7 @@ class ChatGSE:
             ss.conversation.user_name,
             ss.input,
         )
-        ss.conversation.setup(ss.input)
+        apply_prompts(ss.conversation, ss.input)
 
     def _ask_for_data_input(self):
         if not ss.get("tool_data"):
@@ -335,11 +706,14 @@ class ChatGSE:
             msg1 = (
                 f"You have selected `{ss.conversation.context}` as your "
                 "context. Do you want to provide input files from analytic "
-                "methods? They will not be stored or analysed beyond your "
-                "queries. If so, please provide the files by uploading them in "
-                "the sidebar and press 'Yes' once you are finished. I will "
-                "recognise methods if their names are mentioned in the file "
-                "name. These are the tools I am familiar with: "
+                "methods? They are only analysed for your queries, and are "
+                "stored on this server with your conversation, so that "
+                "reloading the page restores it, for "
+                f"{RETENTION_DAYS:g} days after your last change or until you "
+                "reset the app. If so, please provide the files by uploading "
+                "them in the sidebar and press 'Yes' once you are finished. "
+                "I will recognise methods if their names are mentioned in the "
+                "file name. These are the tools I am familiar with: "
                 f"{', '.join([f'`{name}`' for name in known_tools])}. Please "
                 "keep in mind that all data you provide will count towards the "
                 f"token usage of your conversation prompt. The limit of the "
@@ -349,8 +723,8 @@ class ChatGSE:
             msg2 = (
                 "If you don't want to provide any files, please press 'No'. "
                 "You will still be able to provide free text information about "
-                "your results later. Any free text you provide will also not "
-                "be stored or analysed beyond your queries."
+                "your results later. Any free text you provide is stored and "
+                "analysed in the same way."
             )
             self._write_and_history("📎 Assistant", msg2)
             return "getting_data_file_input"
@@ -426,14 +800,10 @@ class ChatGSE:
                 "📎 Assistant",
                 f"`{tool}` results",
             )
-            st.markdown(
-                f"""
-                ```
-                {df.to_markdown()}
-                """
-            )
+            ref = ss.tables.add(tool, df)
+            st.dataframe(df)
 
-            ss.history.append({"tool": df.to_markdown()})
+            ss.history.append("tool", ref)
             logger.info("<Tool data displayed.>")
 
             if not any([tool in fl.name for tool in known_tools]):
@@ -447,7 +817,7 @@ class ChatGSE:
                 )
                 return "getting_data_file_description"
 
-            ss.conversation.setup_data_input_tool(df.to_json(), tool)
+            ss.conversation.setup_data_input_tool(ss.tables.to_json(ref), tool)
 
             self._write_and_history(
                 "📎 Assistant",
@@ -529,16 +899,632 @@ class ChatGSE:
 
         return "chat"
 
-    def _get_response(self):
-        logger.info("Getting response from LLM.")
+    def _compact_conversation(self):
+        """
+        Compact the conversation if the next prompt would exceed the
+        configured share of the model's token limit, by replacing the oldest
+        exchanges with a summary of the questions asked. System prompts and
+        tool data are kept.
+
+        Returns:
+            int: the number of prompt tokens saved
+        """
+        fraction = ss.get("compaction_fraction", COMPACTION_FRACTION)
+        if fraction >= 1:
+            return 0
+
+        model = ss.primary_model
+        budget = int(self._token_limit() * fraction)
+        messages, saved, over = compact_messages(
+            ss.conversation.messages,
+            budget,
+            model=model,
+            reserve=count_tokens(ss.input, model),
+            prefixes=getattr(ss.conversation, "prompt_prefixes", ()),
+        )
+        if saved:
+            logger.info(f"Compacted conversation, saving {saved} tokens.")
+            ss.conversation.messages = messages
+            ss.compaction_saved = ss.get("compaction_saved", 0) + saved
+        if over:
+            # the preflight blocks the query if it exceeds the model limit
+            logger.warning(f"Compacted prompt is {over} tokens over budget.")
 
-        response, token_usage, correction = ss.conversation.query(ss.input)
+        return saved
+
+    def _preflight(self):
+        """
+        Count the tokens of the pending prompt (the conversation and the
+        user's input) before it is sent, leaving room for the response. If it
+        exceeds the model's limit, the oldest exchanges are removed as in
+        compaction, whatever its setting. If it still does not fit, e.g.
+        because the input itself is too long, or because the system messages
+        alone exceed the limit, the query is blocked.
+
+        Returns:
+            int: the number of prompt tokens, or None if the query is blocked
+        """
+        model = ss.primary_model
+        limit = self._token_limit() - COMPLETION_ESTIMATE
+        messages = ss.conversation.messages
+        prefixes = getattr(ss.conversation, "prompt_prefixes", ())
+        current = count_message_tokens(messages, model, prefixes)
+        tokens = count_message_tokens(
+            messages + [HumanMessage(content=ss.input)], model, prefixes
+        )
+        if tokens <= limit:
+            return tokens
+
+        messages, saved, over = compact_messages(
+            messages,
+            limit,
+            model=model,
+            reserve=tokens - current,
+            prefixes=prefixes,
+        )
+        if saved:
+            logger.info(f"Trimmed conversation by {saved} tokens to fit.")
+            ss.conversation.messages = messages
+            ss.compaction_saved = ss.get("compaction_saved", 0) + saved
+            tokens -= saved
+        if not over:
+            return tokens
+
+        start = chat_start(messages)
+        system = count_message_tokens(
+            [
+                m
+                for i, m in enumerate(messages)
+                if i < start or isinstance(m, SystemMessage)
+            ],
+            model,
+            prefixes,
+        )
+        if system > limit:
+            reason = (
+                "The prompts, context, and tool data of the conversation "
+                f"alone take {system} tokens, but the model accepts only "
+                f"{limit} (leaving room for the answer). Please choose a "
+                "model with a larger context, or reset the app and use "
+                "smaller tool data or fewer document fragments."
+            )
+        else:
+            reason = (
+                f"Your message would make the prompt {tokens} tokens long, "
+                f"but the model accepts only {limit} (leaving room for the "
+                "answer). Please shorten your message or choose a model with "
+                "a larger context."
+            )
+        self._write_and_history("📎 Assistant", reason)
+        return None
+
+    @staticmethod
+    def _router_models():
+        """
+        The models the router may choose from for the next query: those of
+        the tier of the selected model, and on the community key none more
+        expensive than it; empty if routing is off or not possible with the
+        current backend.
+        """
+        if (
+            not ss.get("route_models")
+            or ss.get("openai_api_type") == "azure"
+            or ss.primary_model not in OPENAI_MODELS
+        ):
+            return []
+        models = router_models(
+            ss.primary_model, upgrade=ss.get("user") != "community"
+        )
+        # the selected model alone leaves nothing to route
+        return models if len(models) > 1 else []
+
+    def _token_limit(self):
+        """
+        The token limit of the primary model, or the largest limit of the
+        models the router may choose from.
+        """
+        models = self._router_models()
+        if models:
+            return router_limit(models)
+        return ss.token_limit
+
+    def projected_tokens(self):
+        """
+        Number of prompt tokens the conversation adds to the next query,
+        counted once per change of the conversation.
+        """
+        conversation = ss.get("conversation")
+        if not conversation or not conversation.messages:
+            return 0
+        messages = conversation.messages
+        signature = (ss.primary_model, len(messages), id(messages[-1]))
+        if ss.get("projected_tokens_signature") != signature:
+            ss.projected_tokens = count_message_tokens(
+                messages,
+                ss.primary_model,
+                getattr(ss.conversation, "prompt_prefixes", ()),
+            )
+            ss.projected_tokens_signature = signature
+        return ss.projected_tokens
+
+    def _query(
+        self,
+        text: str,
+        on_token=None,
+        on_retry=None,
+        on_wait=None,
+        cache=None,
+        scheduler=None,
+        cancel=None,
+    ):
+        """
+        Query the primary model with the user's message through
+        `Conversation.query`. Where possible, the model is called directly
+        (see `_primary_query`), which allows streaming the response and
+        checking it with the correcting agent in the background (see
+        `_start_correction`); other backends use `Conversation.query` as is,
+        which corrects in line.
+
+        Args:
+            text: the user's message
+
+            on_token: optional callback receiving each token of the response
+                as it is generated
+
+            on_retry: optional callback receiving the number of each retry
+                of a failed request
+
+            on_wait: optional callback receiving the seconds waited for the
+                model, called about twice a second
+
+            cache: optional `ResponseCache` to look up and store responses
+                and corrections
+
+            scheduler: optional `RequestScheduler` to queue requests on the
+                community key; the queue position is shown while waiting
+
+            cancel: optional `threading.Event` that stops the query and its
+                correction when set; it is set when the query is interrupted,
+                e.g. by the rerun of the Stop button
+
+        The query is stopped at the deadline set in the chat settings, or
+        when it is cancelled. A partial response is kept in the
+        conversation, and `ss.query_stopped` is set to the reason; without
+        one, the query counts as failed.
+
+        Returns:
+            tuple: the response, the token usage (None on error), and the
+                correction (None if no correction is necessary or if it runs
+                in the background; "OK" if correction is off, as with
+                `Conversation.query`)
+        """
+        conversation = ss.conversation
+        ss.query_stopped = False
+        # the user message is taken back if the query fails
+        n_messages = len(conversation.messages)
+
+        if not supports_completion(conversation):
+            msg, token_usage, correction = conversation.query(text)
+            if not token_usage:
+                del conversation.messages[n_messages:]
+            return msg, token_usage, correction
+
+        # `Conversation.query` adds the message and the document context, and
+        # asks the model through `_primary_query`, which is replaced for this
+        # query; the correction runs in the background instead of in line
+        correct = conversation.correct
+        conversation._primary_query = functools.partial(
+            self._primary_query,
+            n_messages,
+            on_token=on_token,
+            on_retry=on_retry,
+            on_wait=on_wait,
+            cache=cache,
+            scheduler=scheduler,
+            cancel=cancel,
+        )
+        conversation.correct = False
+        try:
+            msg, token_usage, _ = conversation.query(text)
+        finally:
+            del conversation._primary_query
+            conversation.correct = correct
 
         if not token_usage:
             # indicates error
-            msg = "The model appears to have encountered an error. " + response
+            del conversation.messages[n_messages:]
+            return msg, None, None
+
+        if ss.query_stopped:
+            return msg, token_usage, None
+
+        if not correct:
+            return msg, token_usage, "OK"
+
+        # unlike biochatter, which checks the user's message, the correcting
+        # agent checks the statements of the response
+        self._start_correction(msg, cache, scheduler, cancel)
+        return msg, token_usage, None
+
+    def _primary_query(
+        self,
+        n_messages: int,
+        on_token=None,
+        on_retry=None,
+        on_wait=None,
+        cache=None,
+        scheduler=None,
+        cancel=None,
+    ):
+        """
+        Ask the primary model in place of `Conversation._primary_query`
+        during `_query`: choose the model, look up the response cache, and
+        send the request through `resilient_completion`. As
+        `Conversation._primary_query`, add the response to the conversation
+        and its usage to the usage statistics. The other arguments are those
+        of `_query`.
+
+        Args:
+            n_messages: the number of messages before the query, to which the
+                conversation is reset if it stops without a response
+
+        Returns:
+            tuple: the response and the token usage (None on error)
+        """
+        conversation = ss.conversation
+
+        model = conversation.model_name
+        models = self._router_models()
+        if models:
+            model = (
+                route(
+                    count_message_tokens(
+                        conversation.messages,
+                        model,
+                        getattr(conversation, "prompt_prefixes", ()),
+                    ),
+                    COMPLETION_ESTIMATE,
+                    models,
+                )
+                or model
+            )
+            logger.info(f"Routing query to {model}.")
+        ss.routed_model = model
+
+        cached = None
+        if cache:
+            key = cache.key(
+                "response",
+                model,
+                conversation.prompts,
+                conversation.messages,
+            )
+            cached = cache.get(key)
+
+        if cached:
+            msg, cached_usage = cached
+            # nothing was sent to the model; the usage of the cached response
+            # is reported, but not recorded again
+            token_usage = {
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0,
+                **(cached_usage or {}),
+                "cached": True,
+            }
+            if on_token:
+                on_token(msg)
+
+        else:
+            queue = st.empty()
+
+            def on_position(position: int):
+                queue.info(
+                    "Many people are using the community key right now. "
+                    f"Requests ahead of yours: {position}"
+                )
+
+            # the streamed part of the response, kept if the query stops
+            partial = []
+
+            def forward(token: str):
+                partial.append(token)
+                on_token(token)
+
+            def retry(attempt: int):
+                partial.clear()
+                if on_retry:
+                    on_retry(attempt)
+
+            seconds = ss.get("query_deadline", QUERY_DEADLINE)
+            timings = []
+            try:
+                with request_slot(
+                    scheduler,
+                    conversation,
+                    ss.get("session_token"),
+                    conversation.messages,
+                    on_position=on_position,
+                ) as ticket:
+                    queue.empty()
+                    # duplicate requests would cost the community key double
+                    hedge = ss.get("hedge_requests", False) and not ticket
+                    # the deadline starts once the request is sent
+                    deadline = time.monotonic() + seconds if seconds else None
+                    try:
+                        msg, token_usage = resilient_completion(
+                            conversation,
+                            conversation.messages,
+                            on_token=forward if on_token else None,
+                            on_retry=retry,
+                            on_wait=on_wait,
+                            hedge=hedge,
+                            timings=timings,
+                            model=model,
+                            cancel=cancel,
+                            deadline=deadline,
+                        )
+                    except QueryCancelled as e:
+                        logger.info(f"Query stopped: {e.reason}")
+                        msg, token_usage = self._keep_partial(
+                            n_messages, e.partial, model
+                        )
+                        if not token_usage:
+                            msg = (
+                                "The model did not answer within "
+                                f"{seconds:g} seconds."
+                                if e.reason == "deadline"
+                                else "The query was stopped."
+                            )
+                        ss.query_stopped = e.reason if token_usage else False
+                    if ticket and token_usage:
+                        ticket.settle(token_usage["total_tokens"])
+
+            except BaseException:
+                # the script run is interrupted, e.g. by the rerun of the Stop
+                # button; the requests still running are cancelled
+                if cancel is not None:
+                    cancel.set()
+                self._keep_partial(n_messages, "".join(partial), model)
+                raise
+
+            finally:
+                ss.request_timings = timings
+                logger.info(f"Requests: {timings}")
+
+            if ss.query_stopped:
+                record_usage(conversation, model, token_usage)
+                return msg, token_usage
+
+            if not token_usage:
+                # indicates error
+                return msg, None
+
+            record_usage(conversation, model, token_usage)
+            if cache:
+                cache.put(key, msg, token_usage)
+
+        conversation.append_ai_message(msg)
+        return msg, token_usage
+
+    @staticmethod
+    def _keep_partial(n_messages: int, partial: str, model: str):
+        """
+        Keep the question and the partial response of a stopped query in the
+        conversation. Without a partial response, the question is taken back,
+        so that it can be asked again.
+
+        Returns:
+            tuple: the partial response and its estimated token usage (None
+                without a partial response)
+        """
+        conversation = ss.conversation
+        if not partial:
+            del conversation.messages[n_messages:]
+            return partial, None
+
+        prompt_tokens = count_message_tokens(
+            conversation.messages,
+            model,
+            getattr(conversation, "prompt_prefixes", ()),
+        )
+        completion_tokens = count_tokens(partial, model)
+        conversation.append_ai_message(partial)
+        return partial, {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "estimated": True,
+        }
+
+    @staticmethod
+    def _start_correction(
+        msg: str, cache=None, scheduler=None, cancel=None
+    ):
+        """
+        Have the correcting agent check a response in the background. The
+        worker only uses the conversation object, never the session state;
+        the result is picked up by `_collect_correction`. Setting `cancel`
+        stops the requests not sent yet.
+        """
+        ss.pending_correction = CORRECTION_EXECUTOR.submit(
+            _correct,
+            ss.conversation,
+            msg,
+            cache,
+            scheduler,
+            ss.get("session_token"),
+            cancel,
+        )
+
+    @staticmethod
+    def _cancel_query():
+        """
+        Cancel the running query and its correction; callback of the Stop
+        buttons.
+        """
+        cancel = ss.get("query_cancel")
+        if cancel is not None:
+            cancel.set()
+
+    def _collect_correction(self, wait: bool = False):
+        """
+        Add the result of a background correction to the history once it is
+        available.
+
+        Args:
+            wait: block until the correction is finished
+
+        Returns:
+            bool: whether a correction message was added
+        """
+        future = ss.get("pending_correction")
+        if future is None or not (wait or future.done()):
+            return False
+
+        cor_msg = (
+            "Correcting (using single sentences) ..."
+            if ss.conversation.split_correction
+            else "Correcting ..."
+        )
+        with st.spinner(cor_msg):
+            if not future.done():
+                stop = st.empty()
+                stop.button(
+                    "Stop",
+                    key="stop_correction",
+                    help="Stop the correction.",
+                    on_click=self._cancel_query,
+                )
+                status = st.empty()
+                started = time.monotonic()
+                while not wait_for([future], timeout=0.5).done:
+                    # updating the page lets the Stop button interrupt the
+                    # wait
+                    status.caption(f"{time.monotonic() - started:.0f} s")
+                stop.empty()
+                status.empty()
+            try:
+                corrections = future.result()
+            except QueryCancelled:
+                logger.info("Correction stopped.")
+                corrections = None
+            except Exception as e:
+                logger.warning(f"Correction failed: {e}")
+                corrections = None
+        ss.pending_correction = None
+
+        if not corrections:
+            return False
+
+        self._history_only("🕵️ Correcting agent", "\n".join(corrections))
+        return True
+
+    def _can_stream(self):
+        return ss.get("stream_responses", True) and supports_completion(
+            ss.conversation
+        )
+
+    def _get_response(self, cache=None, scheduler=None):
+        logger.info("Getting response from LLM.")
+
+        self._compact_conversation()
+
+        if self._preflight() is None:
+            # nothing was sent; keep the usage of the last query
+            return ss.input, ss.get("token_usage")
+
+        status = st.empty()
+        # pressing the button reruns the app, which interrupts the query at
+        # the next update of the page and cancels its requests (see `_query`)
+        ss.query_cancel = threading.Event()
+        stop = st.empty()
+        stop.button(
+            "Stop",
+            key="stop_query",
+            help="Stop the response.",
+            on_click=self._cancel_query,
+        )
+
+        def on_retry(attempt: int):
+            status.caption(f"The request failed, retrying ({attempt}) ...")
+
+        def on_wait(seconds: float):
+            status.caption(f"Waiting for the model ... {seconds:.0f} s")
+
+        if self._can_stream():
+            # show the question and the response as it arrives; both are
+            # written to the history below once the response is complete
+            question = st.empty()
+            question.markdown(
+                self._render_msg(ss.conversation.user_name, ss.input)
+            )
+            answer = st.empty()
+            streamed = []
+            last_update = [0.0]
+
+            def on_token(token: str):
+                if not streamed:
+                    status.empty()
+                streamed.append(token)
+                # limit the number of updates sent to the browser
+                if time.monotonic() - last_update[0] > 0.05:
+                    last_update[0] = time.monotonic()
+                    answer.markdown(
+                        self._render_msg("💬🧬 ChatGSE", "".join(streamed))
+                    )
+
+            def on_stream_retry(attempt: int):
+                # discard the tokens of the failed request
+                streamed.clear()
+                answer.empty()
+                on_retry(attempt)
+
+            def on_stream_wait(seconds: float):
+                if not streamed:
+                    on_wait(seconds)
+
+            try:
+                response, token_usage, correction = self._query(
+                    ss.input,
+                    on_token=on_token,
+                    on_retry=on_stream_retry,
+                    on_wait=on_stream_wait,
+                    cache=cache,
+                    scheduler=scheduler,
+                    cancel=ss.query_cancel,
+                )
+            except BaseException:
+                self._record_stopped("".join(streamed))
+                raise
+            question.empty()
+            answer.empty()
+
+        else:
+            try:
+                response, token_usage, correction = self._query(
+                    ss.input,
+                    on_retry=on_retry,
+                    on_wait=on_wait,
+                    cache=cache,
+                    scheduler=scheduler,
+                    cancel=ss.query_cancel,
+                )
+            except BaseException:
+                self._record_stopped("")
+                raise
+
+        status.empty()
+        stop.empty()
+
+        if not token_usage:
+            # indicates error; the question is not part of the conversation,
+            # so it can simply be asked again
+            msg = (
+                "The model appears to have encountered an error. "
+                f"{response} Please try again."
+            )
             self._write_and_history("📎 Assistant", msg)
-            ss.error = True
 
             token_usage = {
                 "prompt_tokens": 0,
@@ -557,4 +1543,24 @@ class ChatGSE:
         else:
             self._write_and_history("💬🧬 ChatGSE", response)
 
+        if ss.get("query_stopped"):
+            self._write_and_history(
+                "📎 Assistant",
+                "The response was stopped at the deadline and is incomplete."
+                if ss.query_stopped == "deadline"
+                else "The response was stopped and is incomplete.",
+            )
+
         return response, token_usage
+
+    def _record_stopped(self, partial: str):
+        """
+        Add the question and the partial response of a query that was
+        interrupted, e.g. by a rerun, to the history, which is all that
+        survives the rerun. The question is not sent again.
+        """
+        if partial:
+            self._history_only(ss.conversation.user_name, ss.input)
+            self._history_only("💬🧬 ChatGSE", partial)
+            self._history_only("📎 Assistant", "The response was stopped.")
+        ss.input = ""
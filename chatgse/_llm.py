@@ -0,0 +1,464 @@
+# ChatGSE LLM calls
+# query the models of a conversation without changing its state
+
+import os
+import queue
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+from langchain.callbacks.base import CallbackManager
+from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from loguru import logger
+
+from chatgse._tokens import count_message_tokens, count_tokens
+
+# number of retries of failed requests, and the delay before the first one;
+# the delay doubles with each retry
+RETRIES = int(os.getenv("CHATGSE_RETRIES", 3))
+RETRY_BACKOFF = float(os.getenv("CHATGSE_RETRY_BACKOFF", 1.0))
+MAX_BACKOFF = 20.0
+
+# seconds a query may take, from sending it to the end of the response;
+# 0 disables the deadline
+QUERY_DEADLINE = float(os.getenv("CHATGSE_QUERY_DEADLINE", 120))
+
+# errors that a retry cannot fix
+PERMANENT_ERRORS = (
+    openai.error.InvalidRequestError,
+    openai.error.AuthenticationError,
+    openai.error.PermissionError,
+)
+
+# requests run here, so that the script thread can forward streamed tokens,
+# hedge slow requests and return as soon as one of them succeeds
+REQUEST_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CHATGSE_REQUEST_WORKERS", 32)),
+    thread_name_prefix="chatgse-request",
+)
+
+
+class TokenHandler(StreamingStdOutCallbackHandler):
+    """
+    Pass each streamed token to a callback.
+    """
+
+    def __init__(self, on_token):
+        self.on_token = on_token
+
+    @property
+    def always_verbose(self):
+        return True
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        self.on_token(token)
+
+
+def supports_completion(conversation):
+    """
+    Whether the primary model of the conversation can be called directly
+    (and streamed), instead of through `Conversation.query`. Conversations
+    can provide a `complete(messages, on_token)` method for this, as the
+    mock backend does.
+    """
+    return hasattr(conversation, "complete") or isinstance(
+        getattr(conversation, "chat", None), ChatOpenAI
+    )
+
+
+class LatencyTracker:
+    """
+    Recent durations of successful requests per model, to tell when a
+    request is unusually slow.
+    """
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._durations = defaultdict(lambda: deque(maxlen=size))
+        self._lock = threading.Lock()
+
+    def record(self, model: str, seconds: float):
+        with self._lock:
+            self._durations[model].append(seconds)
+
+    def quantile(self, model: str, q: float = 0.95):
+        """
+        Returns:
+            float: the quantile of the recent durations, or None if there are
+                too few
+        """
+        with self._lock:
+            durations = sorted(self._durations[model])
+        if len(durations) < self.min_samples:
+            return None
+        return durations[min(int(q * len(durations)), len(durations) - 1)]
+
+
+LATENCIES = LatencyTracker()
+
+
+def primary_completion(conversation, messages: list, on_token=None):
+    """
+    Get a completion of the primary model of a conversation for a list of
+    messages. The conversation itself is not changed.
+
+    Args:
+        conversation: the conversation whose primary model to use
+
+        messages: the langchain messages to complete
+
+        on_token: optional callback receiving each token as it is generated;
+            if given, the response is streamed
+
+    Returns:
+        tuple: the response and the token usage. The token usage is None if
+            the request failed, in which case the response is the error
+            message. Streamed responses report no usage, so it is estimated
+            and marked as `estimated`.
+    """
+    try:
+        return completion(conversation, messages, on_token=on_token)
+    except openai.error.OpenAIError as e:
+        return str(e), None
+
+
+def completion(
+    conversation,
+    messages: list,
+    on_token=None,
+    model: str = None,
+    timeout: float = None,
+):
+    """
+    As `primary_completion`, but raises the errors of the request.
+    Optionally, another model than the conversation's primary model answers
+    (see `chatgse._router`), and the request times out after `timeout`
+    seconds instead of the model's default; backends providing `complete`
+    always use their own model and timing.
+
+    Raises:
+        openai.error.OpenAIError: the request failed
+    """
+    if hasattr(conversation, "complete"):
+        return conversation.complete(messages, on_token=on_token)
+
+    chat = conversation.chat
+    update = {}
+    if model and model != chat.model_name:
+        update["model_name"] = model
+    if timeout:
+        update["request_timeout"] = min(timeout, chat.request_timeout)
+    if on_token:
+        update["streaming"] = True
+        update["callback_manager"] = CallbackManager([TokenHandler(on_token)])
+    if update:
+        chat = chat.copy(update=update)
+
+    response = chat.generate([messages])
+    msg = response.generations[0][0].text
+    token_usage = response.llm_output.get("token_usage")
+
+    if not token_usage:
+        model = chat.model_name
+        prompt_tokens = count_message_tokens(messages, model)
+        completion_tokens = count_tokens(msg, model)
+        token_usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "estimated": True,
+        }
+
+    return msg, token_usage
+
+
+def record_usage(conversation, model: str, token_usage: dict):
+    """
+    Add the usage of a query to the usage statistics of a conversation, as
+    its primary query does. Usage that was estimated instead of reported by
+    the API (marked `estimated`, e.g. of streamed responses) is counted
+    apart from the billed usage, under keys prefixed with `estimated_`.
+    """
+    usage = {k: v for k, v in token_usage.items() if k != "estimated"}
+    if token_usage.get("estimated"):
+        usage = {f"estimated_{k}": v for k, v in usage.items()}
+    conversation._update_usage_stats(model, usage)
+
+
+class QueryCancelled(Exception):
+    """
+    The query was cancelled or passed its deadline.
+    """
+
+    def __init__(self, reason: str, partial: str = ""):
+        super().__init__(reason)
+        self.reason = reason
+        self.partial = partial
+
+
+def resilient_completion(
+    conversation,
+    messages: list,
+    on_token=None,
+    on_retry=None,
+    on_wait=None,
+    hedge: bool = False,
+    timings: list = None,
+    retries: int = None,
+    backoff: float = None,
+    model: str = None,
+    cancel: threading.Event = None,
+    deadline: float = None,
+):
+    """
+    Get a completion as `primary_completion` does, retrying failed requests
+    with exponential backoff. Optionally, a request that takes longer than
+    the 95th percentile of recent requests to the model is hedged: a
+    duplicate request is sent, and whichever succeeds first is used. Streamed
+    requests are only hedged while no token has arrived; the duplicate is
+    not streamed.
+
+    The query can be cancelled, and can be given a deadline. Streamed
+    requests are then aborted at the next token; requests that are not
+    streamed time out at the deadline.
+
+    Args:
+        conversation: the conversation whose primary model to use
+
+        messages: the langchain messages to complete
+
+        on_token: optional callback receiving each token as it is generated
+
+        on_retry: optional callback receiving the number of each retry
+            before it starts, e.g. to discard the tokens of the failed one
+
+        on_wait: optional callback receiving the seconds waited so far,
+            called about twice a second while waiting
+
+        hedge: send duplicates of slow requests
+
+        timings: optional list to which a record of each request is added
+            (attempt, primary or hedge, seconds, outcome)
+
+        retries: number of retries (default: CHATGSE_RETRIES, 3)
+
+        backoff: seconds before the first retry (default:
+            CHATGSE_RETRY_BACKOFF, 1)
+
+        model: the model to use instead of the primary model
+
+        cancel: event that cancels the query when set
+
+        deadline: `time.monotonic()` value by which the query must be done
+
+    Returns:
+        tuple: the response and the token usage. The token usage is None if
+            all attempts failed, in which case the response is the last
+            error message.
+
+    Raises:
+        QueryCancelled: the query was cancelled or passed its deadline
+    """
+    retries = RETRIES if retries is None else retries
+    backoff = RETRY_BACKOFF if backoff is None else backoff
+    request = _Request(
+        conversation,
+        messages,
+        model or getattr(conversation, "model_name", None),
+        on_token=on_token,
+        on_wait=on_wait,
+        timings=[] if timings is None else timings,
+        cancel=cancel,
+        deadline=deadline,
+    )
+
+    for attempt in range(retries + 1):
+        if attempt and on_retry:
+            on_retry(attempt)
+
+        hedge_after = LATENCIES.quantile(request.model) if hedge else None
+        try:
+            return request.attempt(attempt + 1, hedge_after)
+        except PERMANENT_ERRORS as e:
+            return str(e), None
+        except openai.error.OpenAIError as e:
+            error = e
+            if attempt < retries:
+                delay = min(backoff * 2**attempt, MAX_BACKOFF)
+                delay *= random.uniform(0.5, 1.5)
+                logger.warning(
+                    f"Request failed ({e}), retrying in {delay:.1f} s."
+                )
+                request.sleep(delay)
+
+    return str(error), None
+
+
+class _Request:
+    """
+    The requests of one query to the model in `resilient_completion`. They
+    run on the request pool, while the calling thread forwards streamed
+    tokens, hedges slow requests, and watches for cancellation and the
+    deadline.
+    """
+
+    def __init__(
+        self,
+        conversation,
+        messages: list,
+        model: str,
+        on_token=None,
+        on_wait=None,
+        timings: list = None,
+        cancel: threading.Event = None,
+        deadline: float = None,
+    ):
+        self.conversation = conversation
+        self.messages = list(messages)
+        self.model = model
+        self.on_token = on_token
+        self.on_wait = on_wait
+        self.timings = timings
+        self.cancel = cancel
+        self.deadline = deadline
+        self.partial = []
+        self._started = time.perf_counter()
+        self._waited = 0.0
+
+    def check(self):
+        """
+        Raise `QueryCancelled` if the query was cancelled or passed its
+        deadline, and report the time waited.
+        """
+        if self.cancel is not None and self.cancel.is_set():
+            raise QueryCancelled("cancelled", "".join(self.partial))
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise QueryCancelled("deadline", "".join(self.partial))
+
+        waited = time.perf_counter() - self._started
+        if self.on_wait and waited - self._waited >= 0.5:
+            self._waited = waited
+            self.on_wait(waited)
+
+    def sleep(self, seconds: float):
+        until = time.perf_counter() + seconds
+        while time.perf_counter() < until:
+            self.check()
+            time.sleep(min(0.1, max(until - time.perf_counter(), 0)))
+
+    def attempt(self, attempt: int, hedge_after: float = None):
+        """
+        Run one attempt: the request, and its hedge once it takes longer
+        than `hedge_after` seconds.
+
+        Raises:
+            openai.error.OpenAIError: the error of the request, if it and its
+                hedge failed
+
+            QueryCancelled: the query was cancelled or passed its deadline
+        """
+        self.check()
+        tokens = queue.Queue()
+        # aborts the streamed requests of this attempt that are still running
+        stop = threading.Event()
+        started = {}
+        ended = {}
+        self.partial = []
+
+        def put(token: str):
+            if stop.is_set():
+                raise QueryCancelled("stopped")
+            tokens.put(token)
+
+        def submit(stream: bool):
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(self.deadline - time.monotonic(), 1)
+            future = REQUEST_EXECUTOR.submit(
+                completion,
+                self.conversation,
+                self.messages,
+                put if stream else None,
+                self.model,
+                timeout,
+            )
+            started[future] = time.perf_counter()
+            future.add_done_callback(
+                lambda f: ended.setdefault(f, time.perf_counter())
+            )
+            return future
+
+        def forward():
+            streamed = False
+            while True:
+                try:
+                    token = tokens.get_nowait()
+                except queue.Empty:
+                    return streamed
+                streamed = True
+                self.partial.append(token)
+                self.on_token(token)
+
+        futures = [submit(stream=self.on_token is not None)]
+        streamed = False
+        try:
+            while True:
+                streamed = forward() or streamed
+
+                for future in futures:
+                    if future.done() and future.exception() is None:
+                        forward()
+                        return future.result()
+
+                if all(future.done() for future in futures):
+                    raise futures[0].exception()
+
+                self.check()
+
+                if (
+                    len(futures) == 1
+                    and hedge_after is not None
+                    and not streamed
+                    and time.perf_counter() - started[futures[0]]
+                    > hedge_after
+                ):
+                    logger.info(
+                        f"Request slower than {hedge_after:.1f} s, hedging."
+                    )
+                    futures.append(submit(stream=False))
+
+                wait(
+                    [future for future in futures if not future.done()],
+                    timeout=0.02,
+                    return_when=FIRST_COMPLETED,
+                )
+
+        finally:
+            stop.set()
+            self._record(attempt, futures, started, ended)
+
+    def _record(self, attempt: int, futures: list, started, ended):
+        now = time.perf_counter()
+        for i, future in enumerate(futures):
+            if not future.done():
+                outcome = "abandoned"
+            elif future.exception() is not None:
+                outcome = "error"
+            else:
+                outcome = "ok"
+            seconds = ended.get(future, now) - started[future]
+            if outcome == "ok":
+                LATENCIES.record(self.model, seconds)
+            if self.timings is not None:
+                self.timings.append(
+                    {
+                        "attempt": attempt,
+                        "request": "hedge" if i else "primary",
+                        "seconds": round(seconds, 3),
+                        "outcome": outcome,
+                    }
+                )
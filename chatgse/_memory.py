@@ -0,0 +1,197 @@
+# ChatGSE memory accounting
+# estimate per-session memory and spill large objects of idle sessions
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import weakref
+
+import pandas as pd
+from loguru import logger
+
+from chatgse._history import MessageLog
+from chatgse._tables import TableStore
+
+MB = 1024 * 1024
+
+
+def estimate_size(obj, _depth: int = 0) -> int:
+    """
+    Estimate the memory footprint of a session state value in bytes. Known
+    large containers are measured exactly; other objects are traversed to a
+    limited depth, so that client and database connection objects do not
+    make the estimate expensive.
+
+    Args:
+        obj: the object to measure
+
+    Returns:
+        int: estimated size in bytes
+    """
+    if isinstance(obj, TableStore):
+        return obj.nbytes
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return sys.getsizeof(obj)
+    if isinstance(obj, MessageLog):
+        return sum(sys.getsizeof(msg) for _, msg in obj)
+    # uploaded files
+    if hasattr(obj, "getbuffer") and hasattr(obj, "size"):
+        return int(obj.size)
+
+    size = sys.getsizeof(obj)
+    if _depth >= 3:
+        return size
+    if isinstance(obj, dict):
+        size += sum(estimate_size(v, _depth + 1) for v in obj.values())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(estimate_size(v, _depth + 1) for v in obj)
+    elif hasattr(obj, "__dict__"):
+        size += sum(
+            estimate_size(v, _depth + 1) for v in vars(obj).values()
+        )
+    return size
+
+
+class MemoryAccountant:
+    """
+    Process-wide account of the memory used by each session. Sessions report
+    their footprint on every script run. Once the total crosses the limit,
+    the tool tables of sessions that have been idle for a while are spilled
+    to disk, oldest first, until the total is below the limit again.
+
+    Spilled tables are written to a private directory of the process
+    (created with mode 0700), which is removed when the process exits.
+    """
+
+    def __init__(
+        self,
+        limit_mb: float = None,
+        idle_seconds: float = None,
+        spill_dir: str = None,
+    ):
+        """
+        Args:
+            limit_mb: total session memory above which idle sessions are
+                spilled (env: CHATGSE_MEMORY_LIMIT_MB, default 1024)
+
+            idle_seconds: time without a script run after which a session
+                counts as idle (env: CHATGSE_IDLE_SECONDS, default 600)
+
+            spill_dir: directory in which the private spill directory is
+                created (env: CHATGSE_SPILL_DIR, default: the system
+                temporary directory)
+        """
+        self.limit = (
+            limit_mb or float(os.getenv("CHATGSE_MEMORY_LIMIT_MB", 1024))
+        ) * MB
+        self.idle_seconds = idle_seconds or float(
+            os.getenv("CHATGSE_IDLE_SECONDS", 600)
+        )
+        parent = spill_dir or os.getenv("CHATGSE_SPILL_DIR")
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self.spill_dir = tempfile.mkdtemp(prefix="chatgse-spill-", dir=parent)
+        weakref.finalize(
+            self, shutil.rmtree, self.spill_dir, ignore_errors=True
+        )
+        self.spilled_bytes = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def update(self, token: str, state: dict):
+        """
+        Record the current footprint of a session.
+
+        Args:
+            token: the session token
+
+            state: the session state entries to account for
+
+        Returns:
+            int: the estimated footprint in bytes
+        """
+        footprint = sum(estimate_size(v) for v in state.values())
+        tables = state.get("tables")
+        with self._lock:
+            self._sessions[token] = {
+                "footprint": footprint,
+                "last_active": time.monotonic(),
+                "tables": weakref.ref(tables) if tables is not None else None,
+            }
+        return footprint
+
+    def footprint(self, token: str):
+        with self._lock:
+            session = self._sessions.get(token)
+            return session["footprint"] if session else 0
+
+    @property
+    def total(self):
+        with self._lock:
+            return sum(s["footprint"] for s in self._sessions.values())
+
+    def enforce(self):
+        """
+        Spill tables of idle sessions to disk while the total footprint is
+        above the limit. Sessions whose state is gone are dropped. The
+        sessions to spill are chosen under the lock, but written to disk
+        outside of it, so that other sessions can report their footprint
+        meanwhile.
+        """
+        with self._lock:
+            for token in [
+                t
+                for t, s in self._sessions.items()
+                if s["tables"] is not None and s["tables"]() is None
+            ]:
+                del self._sessions[token]
+
+            total = sum(s["footprint"] for s in self._sessions.values())
+            if total <= self.limit:
+                return
+
+            now = time.monotonic()
+            idle = sorted(
+                (
+                    (token, s)
+                    for token, s in self._sessions.items()
+                    if now - s["last_active"] > self.idle_seconds
+                    and s["tables"] is not None
+                ),
+                key=lambda item: item[1]["last_active"],
+            )
+            victims = []
+            for token, session in idle:
+                if total <= self.limit:
+                    break
+                tables = session["tables"]()
+                if tables is None or not tables.nbytes:
+                    continue
+                victims.append((token, session, tables))
+                total -= tables.nbytes
+
+        for token, session, tables in victims:
+            freed = tables.spill(os.path.join(self.spill_dir, token))
+            with self._lock:
+                session["footprint"] -= freed
+                self.spilled_bytes += freed
+            logger.info(f"Spilled {freed / MB:.1f} MB of idle session tables.")
+
+    def metrics(self):
+        """
+        Returns:
+            dict: number of sessions, total and spilled memory in bytes
+        """
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "total_bytes": sum(
+                    s["footprint"] for s in self._sessions.values()
+                ),
+                "spilled_bytes": self.spilled_bytes,
+            }
@@ -0,0 +1,212 @@
+# ChatGSE mock backend
+# simulate a model offline, for development and load tests
+
+import json
+import math
+import os
+import random
+import time
+from typing import Optional
+
+import openai
+from biochatter.llm_connect import Conversation
+
+from chatgse._tokens import count_message_tokens
+
+MOCK_MODELS = ["mock"]
+
+MOCK_TOKEN_LIMITS = {"mock": 4000}
+
+WORDS = (
+    "the pathway activity of these samples suggests a role of inflammatory "
+    "signalling in the observed phenotype which is consistent with reports "
+    "on transcription factor regulation in related cell types"
+).split()
+
+
+def mock_enabled():
+    return os.getenv("CHATGSE_MOCK", "").lower() in ["1", "true", "yes"]
+
+
+class MockModel:
+    """
+    Simulated model. The time to the first token follows a log-normal
+    distribution around a median; tokens then arrive at a fixed rate.
+    Requests fail at a given rate with a rate limit or server error, as the
+    OpenAI API would.
+    """
+
+    def __init__(
+        self,
+        latency: float = None,
+        sigma: float = None,
+        tokens: int = None,
+        token_delay: float = None,
+        error_rate: float = None,
+        seed: int = None,
+    ):
+        """
+        Args:
+            latency: median seconds to the first token (env:
+                CHATGSE_MOCK_LATENCY, default 0.5)
+
+            sigma: spread of the log-normal latency; 0 makes it constant
+                (env: CHATGSE_MOCK_LATENCY_SIGMA, default 0.5)
+
+            tokens: number of tokens per response (env: CHATGSE_MOCK_TOKENS,
+                default 100)
+
+            token_delay: seconds between tokens (env:
+                CHATGSE_MOCK_TOKEN_DELAY, default 0.02)
+
+            error_rate: fraction of failing requests (env:
+                CHATGSE_MOCK_ERROR_RATE, default 0)
+
+            seed: seed of the random generator, for reproducible runs
+        """
+
+        def setting(value, env, default):
+            if value is not None:
+                return value
+            return float(os.getenv(env, default))
+
+        self.latency = setting(latency, "CHATGSE_MOCK_LATENCY", 0.5)
+        self.sigma = setting(sigma, "CHATGSE_MOCK_LATENCY_SIGMA", 0.5)
+        self.tokens = int(setting(tokens, "CHATGSE_MOCK_TOKENS", 100))
+        self.token_delay = setting(
+            token_delay, "CHATGSE_MOCK_TOKEN_DELAY", 0.02
+        )
+        self.error_rate = setting(error_rate, "CHATGSE_MOCK_ERROR_RATE", 0)
+        self._random = random.Random(seed)
+
+    def sample_latency(self):
+        if self.sigma <= 0 or self.latency <= 0:
+            return max(self.latency, 0)
+        return self._random.lognormvariate(math.log(self.latency), self.sigma)
+
+    def sample_error(self):
+        """
+        Returns:
+            openai.error.OpenAIError: the error to fail the request with, or
+                None
+        """
+        if self._random.random() >= self.error_rate:
+            return None
+        if self._random.random() < 0.5:
+            return openai.error.RateLimitError(
+                "Injected error: rate limit reached.", http_status=429
+            )
+        return openai.error.APIError(
+            "Injected error: the server had an error.", http_status=500
+        )
+
+    def text(self, prompt: str):
+        """
+        Generate the tokens of a response to a prompt.
+        """
+        words = [f"Mock response to '{prompt[:50]}':"]
+        words += [
+            self._random.choice(WORDS) for _ in range(max(self.tokens - 1, 0))
+        ]
+        return [w if i == 0 else " " + w for i, w in enumerate(words)]
+
+    def generate(self, messages: list, on_token=None):
+        """
+        Simulate a chat completion.
+
+        Args:
+            messages: langchain messages to respond to
+
+            on_token: optional callback receiving each token as it arrives
+
+        Returns:
+            tuple: the response and the token usage
+
+        Raises:
+            openai.error.OpenAIError: injected errors
+        """
+        time.sleep(self.sample_latency())
+        error = self.sample_error()
+        if error:
+            raise error
+
+        prompt = messages[-1].content if messages else ""
+        tokens = self.text(prompt)
+        for token in tokens:
+            if on_token:
+                on_token(token)
+            time.sleep(self.token_delay)
+
+        prompt_tokens = count_message_tokens(messages)
+        return "".join(tokens), {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+
+
+class MockConversation(Conversation):
+    """
+    Conversation with a `MockModel` in place of an API. Needs no key and no
+    network. Implements the `complete` hook, which the app uses to query
+    and stream without going through `query`.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        prompts: dict,
+        correct: bool = True,
+        split_correction: bool = False,
+        docsum=None,
+        model: MockModel = None,
+    ):
+        super().__init__(
+            model_name=model_name,
+            prompts=prompts,
+            correct=correct,
+            split_correction=split_correction,
+            docsum=docsum,
+        )
+        self.ca_model_name = model_name
+        self.model = model or MockModel()
+
+    def set_api_key(self, api_key: str = None, user: Optional[str] = None):
+        self.user = user
+        return True
+
+    def complete(self, messages: list, on_token=None):
+        return self.model.generate(messages, on_token=on_token)
+
+    def _primary_query(self):
+        try:
+            msg, token_usage = self.complete(self.messages)
+        except openai.error.OpenAIError as e:
+            return str(e), None
+
+        self.append_ai_message(msg)
+        return msg, token_usage
+
+    def _correct_response(self, msg: str):
+        time.sleep(self.model.sample_latency())
+        error = self.model.sample_error()
+        if error:
+            raise error
+        return "OK"
+
+    def complete_correction(self, messages: list):
+        """
+        Check a batch of numbered sentences (see `chatgse._correction`);
+        every sentence is found correct.
+        """
+        time.sleep(self.model.sample_latency())
+        error = self.model.sample_error()
+        if error:
+            raise error
+        n = len(messages[-1].content.splitlines()) if messages else 0
+        return json.dumps(
+            [{"sentence": i + 1, "correction": "OK"} for i in range(n)]
+        )
+
+    def _update_usage_stats(self, model: str, token_usage: dict):
+        pass
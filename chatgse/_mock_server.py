@@ -0,0 +1,226 @@
+# ChatGSE mock server
+# OpenAI-compatible stand-in for load tests of the whole app without network
+#
+# Usage:
+#   python -m chatgse._mock_server --port 8000
+#   OPENAI_API_BASE=http://127.0.0.1:8000/v1 streamlit run app.py
+#
+# Any API key is accepted. Latency, response length and error rate are set
+# with the same environment variables as the mock backend (see `MockModel`)
+# or with the command line options.
+
+import argparse
+import json
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+from loguru import logger
+
+from chatgse._mock import MockModel
+
+ROLES = {
+    "system": SystemMessage,
+    "user": HumanMessage,
+    "assistant": AIMessage,
+}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    Serves the model list and chat completions, with and without streaming
+    (server-sent events), from the `MockModel` of the server.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(
+                200,
+                {
+                    "object": "list",
+                    "data": [
+                        {"id": model, "object": "model", "owned_by": "mock"}
+                        for model in ["gpt-3.5-turbo", "gpt-4", "mock"]
+                    ],
+                },
+            )
+        else:
+            self._send_error(404, "Not found.")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_error(400, "Invalid JSON body.")
+            return
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_error(404, "Not found.")
+            return
+
+        messages = [
+            ROLES.get(m.get("role"), HumanMessage)(
+                content=m.get("content", "")
+            )
+            for m in request.get("messages", [])
+        ]
+        model = request.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if request.get("stream"):
+            self._stream(messages, model, completion_id, created)
+            return
+
+        try:
+            text, usage = self.server.model.generate(messages)
+        except openai.error.OpenAIError as e:
+            self._send_error(e.http_status or 500, e.user_message)
+            return
+
+        self._send_json(
+            200,
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            },
+        )
+
+    def _stream(self, messages, model, completion_id, created):
+        def chunk(delta: dict, finish_reason=None):
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": finish_reason,
+                    }
+                ],
+            }
+
+        started = []
+
+        def on_token(token: str):
+            if not started:
+                # errors can only be reported before the stream starts
+                started.append(True)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self._send_event(chunk({"role": "assistant"}))
+            self._send_event(chunk({"content": token}))
+
+        try:
+            self.server.model.generate(messages, on_token=on_token)
+        except openai.error.OpenAIError as e:
+            self._send_error(e.http_status or 500, e.user_message)
+            return
+
+        if not started:
+            on_token("")
+        self._send_event(chunk({}, finish_reason="stop"))
+        self._send_chunk(b"data: [DONE]\n\n")
+        self._send_chunk(b"")
+
+    def _send_event(self, data: dict):
+        self._send_chunk(f"data: {json.dumps(data)}\n\n".encode())
+
+    def _send_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str):
+        self._send_json(
+            status,
+            {
+                "error": {
+                    "message": message,
+                    "type": "mock_error",
+                    "param": None,
+                    "code": None,
+                }
+            },
+        )
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, model: MockModel = None):
+        super().__init__(address, MockHandler)
+        self.model = model or MockModel()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="OpenAI-compatible mock server for ChatGSE load tests."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--latency", type=float, help="median seconds to the first token"
+    )
+    parser.add_argument(
+        "--sigma", type=float, help="spread of the log-normal latency"
+    )
+    parser.add_argument("--tokens", type=int, help="tokens per response")
+    parser.add_argument(
+        "--token-delay", type=float, help="seconds between tokens"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, help="fraction of failing requests"
+    )
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    model = MockModel(
+        latency=args.latency,
+        sigma=args.sigma,
+        tokens=args.tokens,
+        token_delay=args.token_delay,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    server = MockServer((args.host, args.port), model)
+    logger.info(f"Mock server listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# ChatGSE shared prompts
+# build the system prompts of a prompt set once per process
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from langchain.schema import SystemMessage
+
+from chatgse._tokens import TOKENS_PER_PROMPT, count_message_tokens
+
+# number of prompt sets kept; edited sets in the "Prompt Engineering" tab
+# each add one
+MAX_PREFIXES = 64
+
+
+class PromptPrefix:
+    """
+    The system messages of one agent of a prompt set, shared by all
+    conversations using the set, with their token counts per model. The
+    messages must not be changed; conversations keep them at the start of
+    their own message lists.
+    """
+
+    def __init__(self, prompts: list):
+        self.messages = tuple(SystemMessage(content=p) for p in prompts if p)
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def starts(self, messages: list):
+        """
+        Whether a message list starts with the messages of the prefix.
+        """
+        return len(messages) >= len(self.messages) and all(
+            a is b for a, b in zip(self.messages, messages)
+        )
+
+    def tokens(self, model: str = None):
+        """
+        The tokens of the messages, without the overhead of the prompt;
+        counted once per model.
+        """
+        with self._lock:
+            if model not in self._tokens:
+                self._tokens[model] = (
+                    count_message_tokens(list(self.messages), model)
+                    - TOKENS_PER_PROMPT
+                )
+            return self._tokens[model]
+
+
+_prefixes = OrderedDict()
+_lock = threading.Lock()
+
+
+def prompt_digest(prompts: dict):
+    """
+    Hash of the prompts of the primary model and the correcting agent.
+    """
+    content = json.dumps(
+        [
+            prompts.get("primary_model_prompts", []),
+            prompts.get("correcting_agent_prompts", []),
+        ]
+    )
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def prompt_prefixes(prompts: dict):
+    """
+    The shared prefixes of a prompt set, built on first use.
+
+    Returns:
+        tuple: the `PromptPrefix` of the primary model and of the correcting
+            agent
+    """
+    digest = prompt_digest(prompts)
+    with _lock:
+        if digest in _prefixes:
+            _prefixes.move_to_end(digest)
+        else:
+            _prefixes[digest] = (
+                PromptPrefix(prompts.get("primary_model_prompts", [])),
+                PromptPrefix(prompts.get("correcting_agent_prompts", [])),
+            )
+            if len(_prefixes) > MAX_PREFIXES:
+                _prefixes.popitem(last=False)
+        return _prefixes[digest]
+
+
+def apply_prompts(conversation, context: str):
+    """
+    Set up a conversation with the prompts of its prompt set and a context,
+    as `Conversation.setup` does, but with the shared prompt messages.
+    """
+    primary, correcting = prompt_prefixes(conversation.prompts)
+    conversation.prompt_prefixes = (primary, correcting)
+    conversation.messages.extend(primary.messages)
+    conversation.ca_messages.extend(correcting.messages)
+
+    conversation.context = context
+    msg = f"The topic of the research is {context}."
+    conversation.append_system_message(msg)
+
+
+def share_prompts(conversation):
+    """
+    Replace the prompt messages at the start of the message lists of a
+    conversation, e.g. of a restored one, with the shared messages of its
+    prompt set, where they have the same content.
+    """
+    prefixes = prompt_prefixes(conversation.prompts)
+    conversation.prompt_prefixes = prefixes
+    for name, prefix in zip(["messages", "ca_messages"], prefixes):
+        messages = getattr(conversation, name)
+        n = len(prefix.messages)
+        if len(messages) >= n and all(
+            isinstance(a, SystemMessage) and a.content == b.content
+            for a, b in zip(messages, prefix.messages)
+        ):
+            setattr(conversation, name, list(prefix.messages) + messages[n:])
@@ -0,0 +1,129 @@
+# ChatGSE model router
+# choose the cheapest model that fits the prompt, per query
+
+import os
+
+# context size, USD per 1k prompt and completion tokens, typical seconds per
+# response, and tier of the models the router can choose from; queries are
+# only routed within the tier of the selected model
+MODEL_TABLE = {
+    "gpt-3.5-turbo": {
+        "limit": 4000,
+        "prompt": 0.0015,
+        "completion": 0.002,
+        "latency": 2.0,
+        "tier": "gpt-3.5",
+    },
+    "gpt-3.5-turbo-0613": {
+        "limit": 4000,
+        "prompt": 0.0015,
+        "completion": 0.002,
+        "latency": 2.0,
+        "tier": "gpt-3.5",
+    },
+    "gpt-3.5-turbo-16k": {
+        "limit": 16000,
+        "prompt": 0.003,
+        "completion": 0.004,
+        "latency": 3.0,
+        "tier": "gpt-3.5",
+    },
+    "gpt-4": {
+        "limit": 8000,
+        "prompt": 0.03,
+        "completion": 0.06,
+        "latency": 8.0,
+        "tier": "gpt-4",
+    },
+}
+
+
+def router_models(selected: str = None, upgrade: bool = True):
+    """
+    The models the router chooses from (env: CHATGSE_ROUTER_MODELS, comma
+    separated, default gpt-3.5-turbo and gpt-3.5-turbo-16k).
+
+    Args:
+        selected: the model chosen by the user; if given, only the models of
+            its tier and the model itself, and none if it is not known to
+            the router
+
+        upgrade: whether models more expensive than the selected one may be
+            chosen; off e.g. for the community key
+
+    Returns:
+        list: the models
+    """
+    models = os.getenv(
+        "CHATGSE_ROUTER_MODELS", "gpt-3.5-turbo,gpt-3.5-turbo-16k"
+    )
+    models = [m.strip() for m in models.split(",")]
+    models = [m for m in models if m in MODEL_TABLE]
+    if selected is None:
+        return models
+    if selected not in MODEL_TABLE:
+        return []
+
+    entry = MODEL_TABLE[selected]
+    candidates = [selected] + [
+        m
+        for m in models
+        if m != selected and MODEL_TABLE[m]["tier"] == entry["tier"]
+    ]
+    if upgrade:
+        return candidates
+    return [
+        m
+        for m in candidates
+        if MODEL_TABLE[m]["prompt"] <= entry["prompt"]
+        and MODEL_TABLE[m]["completion"] <= entry["completion"]
+    ]
+
+
+def router_limit(models: list = None):
+    """
+    The largest prompt the router can place.
+    """
+    models = router_models() if models is None else models
+    return max((MODEL_TABLE[m]["limit"] for m in models), default=0)
+
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int):
+    entry = MODEL_TABLE[model]
+    return (
+        prompt_tokens * entry["prompt"]
+        + completion_tokens * entry["completion"]
+    ) / 1000
+
+
+def route(prompt_tokens: int, completion_tokens: int, models: list = None):
+    """
+    Choose the model for a query: the cheapest of the models whose context
+    fits the prompt and the expected response, and the fastest of equally
+    cheap ones.
+
+    Args:
+        prompt_tokens: tokens of the prompt
+
+        completion_tokens: expected tokens of the response
+
+        models: the models to choose from (default: `router_models`)
+
+    Returns:
+        str: the chosen model, or None if the prompt fits none of them
+    """
+    models = router_models() if models is None else models
+    fitting = [
+        m
+        for m in models
+        if prompt_tokens + completion_tokens <= MODEL_TABLE[m]["limit"]
+    ]
+    if not fitting:
+        return None
+    return min(
+        fitting,
+        key=lambda m: (
+            cost(m, prompt_tokens, completion_tokens),
+            MODEL_TABLE[m]["latency"],
+        ),
+    )
@@ -0,0 +1,219 @@
+# ChatGSE request scheduler
+# share the rate limits of the community key fairly between sessions
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+from chatgse._tokens import count_message_tokens
+
+# expected length of a response, to schedule requests before it is known
+COMPLETION_ESTIMATE = 256
+
+
+class Ticket:
+    """
+    A queued request of one session.
+    """
+
+    __slots__ = ("session", "tokens", "_scheduler")
+
+    def __init__(self, scheduler, session: str, tokens: int):
+        self._scheduler = scheduler
+        self.session = session
+        self.tokens = tokens
+
+    def settle(self, tokens: int):
+        """
+        Correct the token bucket once the actual usage of the request is
+        known.
+        """
+        self._scheduler._settle(self.tokens, tokens)
+        self.tokens = tokens
+
+
+class RequestScheduler:
+    """
+    Process-wide scheduler for requests on a shared key. Two token buckets
+    limit the requests and the tokens per minute. Waiting requests are
+    queued per session and served round robin, so a session sending many
+    requests cannot hold up the others.
+    """
+
+    def __init__(self, rpm: float = None, tpm: float = None):
+        """
+        Args:
+            rpm: requests per minute (env: CHATGSE_COMMUNITY_RPM, default
+                3500)
+
+            tpm: tokens per minute (env: CHATGSE_COMMUNITY_TPM, default
+                90000)
+        """
+        self.rpm = rpm or float(os.getenv("CHATGSE_COMMUNITY_RPM", 3500))
+        self.tpm = tpm or float(os.getenv("CHATGSE_COMMUNITY_TPM", 90000))
+
+        self._requests = self.rpm
+        self._tokens = self.tpm
+        self._refilled = time.monotonic()
+
+        # tickets per session, and the sessions in the order they are served
+        self._queues = {}
+        self._order = deque()
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, session: str, tokens: int, on_position=None):
+        """
+        Wait for the turn of a request.
+
+        Args:
+            session: the session sending the request
+
+            tokens: the expected number of tokens of the request
+
+            on_position: optional callback receiving the number of requests
+                ahead in the queue whenever it changes
+
+        Yields:
+            Ticket: the ticket of the request, to settle its actual usage
+        """
+        ticket = Ticket(self, session, tokens)
+        with self._cond:
+            if session not in self._queues:
+                self._queues[session] = deque()
+                self._order.append(session)
+            self._queues[session].append(ticket)
+
+        try:
+            self._wait(ticket, on_position)
+        except BaseException:
+            self._remove(ticket)
+            raise
+
+        yield ticket
+
+    def queued(self):
+        """
+        Returns:
+            int: number of waiting requests
+        """
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def _wait(self, ticket: Ticket, on_position=None):
+        last_position = None
+        while True:
+            with self._cond:
+                self._refill()
+                if self._next() is ticket:
+                    timeout = self._time_to_grant(ticket)
+                    if timeout <= 0:
+                        self._grant(ticket)
+                        return
+                    position = 0
+                else:
+                    timeout = 1.0
+                    position = self._position(ticket)
+
+            if on_position and position != last_position:
+                on_position(position)
+                last_position = position
+
+            with self._cond:
+                self._cond.wait(timeout)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._refilled
+        self._refilled = now
+        self._requests = min(
+            self.rpm, self._requests + elapsed * self.rpm / 60
+        )
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _next(self):
+        return self._queues[self._order[0]][0]
+
+    def _time_to_grant(self, ticket: Ticket):
+        # requests larger than the bucket go through once it is full
+        tokens = min(ticket.tokens, self.tpm)
+        return max(
+            (1 - self._requests) * 60 / self.rpm,
+            (tokens - self._tokens) * 60 / self.tpm,
+            0,
+        )
+
+    def _grant(self, ticket: Ticket):
+        self._requests -= 1
+        self._tokens -= ticket.tokens
+        session = self._order.popleft()
+        queue = self._queues[session]
+        queue.popleft()
+        if queue:
+            self._order.append(session)
+        else:
+            del self._queues[session]
+        self._cond.notify_all()
+
+    def _remove(self, ticket: Ticket):
+        with self._cond:
+            queue = self._queues.get(ticket.session)
+            if not queue or ticket not in queue:
+                return
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.session]
+                self._order.remove(ticket.session)
+            self._cond.notify_all()
+
+    def _position(self, ticket: Ticket):
+        """
+        Number of requests served before the ticket in round robin order.
+        """
+        rank = self._queues[ticket.session].index(ticket)
+        own = self._order.index(ticket.session)
+        position = rank
+        for i, session in enumerate(self._order):
+            if session == ticket.session:
+                continue
+            rounds = rank + 1 if i < own else rank
+            position += min(len(self._queues[session]), rounds)
+        return position
+
+    def _settle(self, expected: int, actual: int):
+        with self._cond:
+            self._tokens -= actual - expected
+
+
+def request_slot(
+    scheduler,
+    conversation,
+    session: str,
+    messages: list,
+    model: str = None,
+    **kwargs,
+):
+    """
+    Wait for the turn of a request on the community key in the process-wide
+    `RequestScheduler`. Requests on the users' own keys are not scheduled.
+    Each request needs its own slot, also the concurrent requests of one
+    correction.
+
+    Args:
+        model: the model counting the tokens of the messages (default: the
+            primary model of the conversation)
+
+    Returns:
+        context manager yielding the `Ticket` of the request, or None
+    """
+    if scheduler is None or getattr(conversation, "user", None) != "community":
+        return nullcontext()
+
+    tokens = count_message_tokens(
+        messages,
+        model or conversation.model_name,
+        getattr(conversation, "prompt_prefixes", ()),
+    )
+    return scheduler.slot(session, tokens + COMPLETION_ESTIMATE, **kwargs)
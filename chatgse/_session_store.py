@@ -0,0 +1,359 @@
+# ChatGSE session store
+# persist sessions to a local SQLite database to survive app reloads
+
+import hashlib
+import json
+import os
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+from io import StringIO
+
+import pandas as pd
+from loguru import logger
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
+MESSAGE_TYPES = {
+    "system": SystemMessage,
+    "human": HumanMessage,
+    "ai": AIMessage,
+}
+
+# days a session is kept after its last change
+RETENTION_DAYS = float(os.getenv("CHATGSE_SESSION_RETENTION_DAYS", 7))
+
+# seconds between purges of expired sessions
+PURGE_INTERVAL = 3600
+
+# tables holding the rows of a session besides `sessions`
+SESSION_TABLES = ["history", "messages", "tables"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    mode TEXT,
+    prompts TEXT,
+    state TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS history (
+    token TEXT,
+    seq INTEGER,
+    role TEXT,
+    msg TEXT,
+    PRIMARY KEY (token, seq)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    token TEXT,
+    agent TEXT,
+    seq INTEGER,
+    type TEXT,
+    content TEXT,
+    PRIMARY KEY (token, agent, seq)
+);
+CREATE TABLE IF NOT EXISTS tables (
+    token TEXT,
+    ref TEXT,
+    data TEXT,
+    PRIMARY KEY (token, ref)
+);
+"""
+
+
+class SessionStore:
+    """
+    Local SQLite store of chat sessions, addressed by a random token. The
+    database runs in WAL mode, so reads do not block on writes. Writes are
+    queued and applied by a background thread in batched transactions
+    (write-behind), so persisting the state costs the script run no more than
+    putting a few statements on a queue. Restoring a session only waits for
+    the queued writes of that session. Sessions not changed for the retention
+    period are purged.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_interval: float = 0.5,
+        batch_size: int = 500,
+        retention_days: float = None,
+    ):
+        """
+        Args:
+            path: location of the SQLite database file
+
+            flush_interval: maximum number of seconds a write stays queued
+
+            batch_size: maximum number of statements per transaction
+
+            retention_days: days after its last change a session is deleted
+                (env: CHATGSE_SESSION_RETENTION_DAYS, default 7)
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retention_days = retention_days
+        if self.retention_days is None:
+            self.retention_days = RETENTION_DAYS
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self.purge()
+        self._next_purge = time.monotonic() + PURGE_INTERVAL
+
+        self._queue = queue.Queue()
+        # number of queued writes per session token
+        self._pending = {}
+        self._committed = threading.Condition()
+        self._writer = threading.Thread(target=self._write_behind, daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def new_token():
+        return secrets.token_urlsafe(16)
+
+    @staticmethod
+    def fingerprint(key: str):
+        """
+        Identify the API key a session was created with, without storing it.
+        """
+        if not key:
+            return None
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    def put(self, ops: list, token: str = None):
+        """
+        Queue write operations.
+
+        Args:
+            ops: list of (sql, params) tuples. Params may be a callable, which
+                is evaluated by the writer thread, so that expensive
+                serialisation also happens behind the script run.
+
+            token: the session the operations belong to
+        """
+        if not ops:
+            return
+        with self._committed:
+            self._pending[token] = self._pending.get(token, 0) + len(ops)
+        for op in ops:
+            self._queue.put((token, op))
+
+    def wait(self, token: str):
+        """
+        Block until the queued writes of one session are committed.
+        """
+        with self._committed:
+            if not self._pending.get(token):
+                return
+        # a None marker makes the writer commit without waiting for the batch
+        self._queue.put(None)
+        with self._committed:
+            self._committed.wait_for(lambda: not self._pending.get(token))
+
+    def flush(self):
+        """
+        Block until all queued writes are committed.
+        """
+        # a None marker makes the writer commit without waiting for the batch
+        self._queue.put(None)
+        self._queue.join()
+
+    def _write_behind(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            ops = [item for item in batch if item is not None]
+            try:
+                # serialise before taking the lock, so that reads go on
+                statements = [
+                    (sql, params() if callable(params) else params)
+                    for _, (sql, params) in ops
+                ]
+                now = time.time()
+                with self._lock, self._conn:
+                    for sql, params in statements:
+                        self._conn.execute(sql, params)
+                    # any write counts as a change of the session
+                    for token in {token for token, _ in ops}:
+                        self._conn.execute(
+                            "UPDATE sessions SET updated = ? WHERE token = ?",
+                            (now, token),
+                        )
+            except Exception as e:
+                logger.error(f"Could not persist session batch: {e}")
+            finally:
+                with self._committed:
+                    for token, _ in ops:
+                        self._pending[token] -= 1
+                        if not self._pending[token]:
+                            del self._pending[token]
+                    self._committed.notify_all()
+                for _ in batch:
+                    self._queue.task_done()
+
+            if time.monotonic() >= self._next_purge:
+                self._next_purge = time.monotonic() + PURGE_INTERVAL
+                try:
+                    self.purge()
+                except Exception as e:
+                    logger.error(f"Could not purge expired sessions: {e}")
+
+    def purge(self, before: float = None):
+        """
+        Delete the sessions last changed before a time, with all their rows.
+
+        Args:
+            before: epoch seconds; defaults to the start of the retention
+                period
+        """
+        if before is None:
+            before = time.time() - self.retention_days * 86400
+        with self._lock, self._conn:
+            n = self._conn.execute(
+                "DELETE FROM sessions WHERE updated < ?", (before,)
+            ).rowcount
+            # also rows of sessions that were deleted or never registered
+            for table in SESSION_TABLES:
+                self._conn.execute(
+                    f"DELETE FROM {table} "
+                    "WHERE token NOT IN (SELECT token FROM sessions)"
+                )
+        if n:
+            logger.info(f"Purged {n} expired sessions.")
+
+    def load(self, token: str):
+        """
+        Load a persisted session, including its writes that are still queued.
+        Queued writes of other sessions are not waited for.
+
+        Args:
+            token: the session token
+
+        Returns:
+            dict: the session, or None if the token is unknown. Keys are
+                `mode`, `prompts`, `state`, `history` (list of (role,
+                message)), `messages` and `ca_messages` (lists of langchain
+                messages) and `tables` (dict of DataFrames).
+        """
+        self.wait(token)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mode, prompts, state FROM sessions WHERE token = ?",
+                (token,),
+            ).fetchone()
+            if not row:
+                return None
+
+            history = self._conn.execute(
+                "SELECT role, msg FROM history WHERE token = ? ORDER BY seq",
+                (token,),
+            ).fetchall()
+            messages = self._conn.execute(
+                "SELECT agent, type, content FROM messages WHERE token = ? "
+                "ORDER BY agent, seq",
+                (token,),
+            ).fetchall()
+            tables = self._conn.execute(
+                "SELECT ref, data FROM tables WHERE token = ?",
+                (token,),
+            ).fetchall()
+
+        mode, prompts, state = row
+        session = {
+            "mode": mode,
+            "prompts": json.loads(prompts) if prompts else None,
+            "state": json.loads(state) if state else {},
+            "history": history,
+            "messages": [],
+            "ca_messages": [],
+            "tables": {
+                ref: pd.read_json(StringIO(data), orient="split")
+                for ref, data in tables
+            },
+        }
+        for agent, kind, content in messages:
+            session[agent].append(MESSAGE_TYPES[kind](content=content))
+
+        return session
+
+    # statement builders, used by the app to describe changes to a session
+
+    @staticmethod
+    def session_op(token: str, mode: str, prompts: dict, state: dict):
+        return (
+            "INSERT OR REPLACE INTO sessions "
+            "(token, mode, prompts, state, updated) VALUES (?, ?, ?, ?, ?)",
+            (
+                token,
+                mode,
+                json.dumps(prompts),
+                json.dumps(state, default=str),
+                time.time(),
+            ),
+        )
+
+    @staticmethod
+    def delete_ops(token: str):
+        """
+        Statements deleting all rows of a session.
+        """
+        return [
+            (f"DELETE FROM {table} WHERE token = ?", (token,))
+            for table in ["sessions"] + SESSION_TABLES
+        ]
+
+    @staticmethod
+    def history_op(token: str, seq: int, role: str, msg: str):
+        return (
+            "INSERT OR REPLACE INTO history (token, seq, role, msg) "
+            "VALUES (?, ?, ?, ?)",
+            (token, seq, role, msg),
+        )
+
+    @staticmethod
+    def truncate_history_op(token: str, length: int):
+        return (
+            "DELETE FROM history WHERE token = ? AND seq >= ?",
+            (token, length),
+        )
+
+    @staticmethod
+    def message_op(token: str, agent: str, seq: int, message):
+        return (
+            "INSERT OR REPLACE INTO messages "
+            "(token, agent, seq, type, content) VALUES (?, ?, ?, ?, ?)",
+            (token, agent, seq, message.type, message.content),
+        )
+
+    @staticmethod
+    def truncate_messages_op(token: str, agent: str, length: int):
+        return (
+            "DELETE FROM messages WHERE token = ? AND agent = ? AND seq >= ?",
+            (token, agent, length),
+        )
+
+    @staticmethod
+    def table_op(token: str, ref: str, df: pd.DataFrame):
+        return (
+            "INSERT OR REPLACE INTO tables (token, ref, data) VALUES (?, ?, ?)",
+            lambda: (token, ref, df.to_json(orient="split")),
+        )
@@ -0,0 +1,115 @@
+# ChatGSE table store
+# keep uploaded tool tables once per session, render and export on demand
+
+import os
+import threading
+import uuid
+import weakref
+
+import pandas as pd
+
+
+class TableStore:
+    """
+    Per-session store of the tables read from uploaded tool files. The chat
+    history only holds a reference (the key returned by `add`) for each
+    table; markdown and JSON representations are produced when they are
+    needed for export or for the prompt, instead of being kept alongside the
+    DataFrame.
+
+    Tables can be spilled to disk to free memory of idle sessions; they are
+    loaded again transparently on the next access. Spilled files are removed
+    once the store is garbage collected, e.g. when its session expires or is
+    reset.
+    """
+
+    def __init__(self):
+        self._refs = []
+        self._tables = {}
+        self._spilled = {}
+        self._nbytes = {}
+        self._lock = threading.Lock()
+        weakref.finalize(self, _remove_files, self._spilled)
+
+    def add(self, name: str, df: pd.DataFrame):
+        """
+        Store a table.
+
+        Args:
+            name: name of the table, usually the tool it was derived from
+
+            df: the table
+
+        Returns:
+            str: reference to the stored table
+        """
+        ref = name
+        n = 1
+        while ref in self:
+            n += 1
+            ref = f"{name}_{n}"
+        with self._lock:
+            self._refs.append(ref)
+            self._tables[ref] = df
+            self._nbytes[ref] = int(df.memory_usage(deep=True).sum())
+        return ref
+
+    def get(self, ref: str):
+        with self._lock:
+            if ref in self._spilled:
+                path = self._spilled.pop(ref)
+                self._tables[ref] = pd.read_pickle(path)
+                os.remove(path)
+            return self._tables[ref]
+
+    def __contains__(self, ref: str):
+        return ref in self._nbytes
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __iter__(self):
+        return iter(list(self._refs))
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the tables currently held in memory.
+        """
+        with self._lock:
+            return sum(self._nbytes[ref] for ref in self._tables)
+
+    def spill(self, directory: str):
+        """
+        Write all tables held in memory to `directory` and release them.
+
+        Args:
+            directory: directory to write the tables to
+
+        Returns:
+            int: number of bytes released
+        """
+        os.makedirs(directory, exist_ok=True)
+        freed = 0
+        with self._lock:
+            for ref, df in list(self._tables.items()):
+                path = os.path.join(directory, f"{uuid.uuid4().hex}.pkl")
+                df.to_pickle(path)
+                self._spilled[ref] = path
+                del self._tables[ref]
+                freed += self._nbytes[ref]
+        return freed
+
+    def to_markdown(self, ref: str):
+        return self.get(ref).to_markdown()
+
+    def to_json(self, ref: str):
+        return self.get(ref).to_json()
+
+
+def _remove_files(spilled: dict):
+    for path in list(spilled.values()):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,144 @@
+# ChatGSE token estimation
+# count the tokens of prompts locally, before they are sent
+
+import threading
+import time
+
+from loguru import logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# overhead of the chat format per message (including the role) and per
+# completion prompt, see the OpenAI cookbook on counting tokens
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_PROMPT = 3
+
+# models whose messages take one more token of overhead
+LEGACY_MODELS = ["gpt-3.5-turbo-0301"]
+
+ROLES = {"system": "system", "human": "user", "ai": "assistant"}
+
+
+# seconds before loading a tokeniser is tried again after it failed, e.g.
+# because its files could not be downloaded; doubles with each failure
+RETRY_AFTER = 60
+MAX_RETRY_AFTER = 3600
+
+_encodings = {}
+_failures = {}
+_lock = threading.Lock()
+
+
+def encoding(model: str):
+    """
+    The tokeniser of a model, loaded once per process. If loading it fails,
+    it is tried again after `RETRY_AFTER` seconds, and then after twice as
+    long each time, up to `MAX_RETRY_AFTER`.
+
+    Returns:
+        tiktoken.Encoding: the tokeniser, or None if the model is not an
+            OpenAI model or the tokeniser is not available (tiktoken is not
+            installed, or its files cannot be downloaded)
+    """
+    if tiktoken is None or not model:
+        return None
+    with _lock:
+        if model in _encodings:
+            return _encodings[model]
+        failure = _failures.get(model)
+        if failure and time.monotonic() < failure[0]:
+            return None
+
+    try:
+        enc = tiktoken.encoding_for_model(model)
+    except KeyError:
+        # not an OpenAI model
+        enc = None
+    except Exception as e:
+        delay = (
+            min(failure[1] * 2, MAX_RETRY_AFTER) if failure else RETRY_AFTER
+        )
+        logger.warning(
+            f"Tokeniser for {model} not available ({e}), trying again in "
+            f"{delay:.0f} s."
+        )
+        with _lock:
+            _failures[model] = (time.monotonic() + delay, delay)
+        return None
+
+    with _lock:
+        _encodings[model] = enc
+        _failures.pop(model, None)
+    return enc
+
+
+def count_tokens(text: str, model: str = None) -> int:
+    """
+    Count the tokens of a text with the tokeniser of the model. Without a
+    tokeniser, estimate them (about four characters per token for English
+    text with the OpenAI tokenisers).
+
+    Args:
+        text: the text to count
+
+        model: the model the text is meant for
+
+    Returns:
+        int: the number of tokens
+    """
+    if not text:
+        return 0
+    enc = encoding(model)
+    if enc is None:
+        return len(text) // 4 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(
+    messages: list, model: str = None, prefixes: tuple = ()
+) -> int:
+    """
+    Count the prompt tokens of a list of chat messages.
+
+    Args:
+        messages: langchain messages
+
+        model: the model the messages are meant for
+
+        prefixes: shared prompt prefixes (see `chatgse._prompts`); if the
+            messages start with one, its memoised count is used
+
+    Returns:
+        int: the number of prompt tokens
+    """
+    counted = 0
+    for prefix in prefixes:
+        if prefix.starts(messages):
+            counted = prefix.tokens(model)
+            messages = messages[len(prefix.messages) :]
+            break
+
+    if encoding(model) is None:
+        return (
+            TOKENS_PER_PROMPT
+            + counted
+            + sum(
+                TOKENS_PER_MESSAGE + count_tokens(m.content, model)
+                for m in messages
+            )
+        )
+
+    per_message = 4 if model in LEGACY_MODELS else 3
+    return (
+        TOKENS_PER_PROMPT
+        + counted
+        + sum(
+            per_message
+            + count_tokens(ROLES.get(m.type, m.type), model)
+            + count_tokens(m.content, model)
+            for m in messages
+        )
+    )
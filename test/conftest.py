@@ -0,0 +1,25 @@
+import pytest
+
+from chatgse import _interface
+
+
+class SessionState(dict):
+    """
+    Stand-in for `st.session_state`: a dict with attribute access.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+@pytest.fixture
+def session_state(monkeypatch):
+    state = SessionState()
+    monkeypatch.setattr(_interface, "ss", state)
+    return state
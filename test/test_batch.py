@@ -0,0 +1,109 @@
+import csv
+import json
+import sys
+
+import pytest
+
+from chatgse import _batch
+
+PROMPTS = {
+    "primary_model_prompts": ["You are an assistant."],
+    "correcting_agent_prompts": ["Check the statements."],
+    "tool_prompts": {},
+}
+
+
+@pytest.fixture
+def fast_mock(monkeypatch):
+    monkeypatch.setenv("CHATGSE_MOCK_LATENCY", "0")
+    monkeypatch.setenv("CHATGSE_MOCK_TOKEN_DELAY", "0")
+    monkeypatch.setenv("CHATGSE_MOCK_TOKENS", "5")
+    monkeypatch.setenv("CHATGSE_MOCK_ERROR_RATE", "0")
+
+
+def _run_cli(monkeypatch, tmp_path, out: str, *extra):
+    prompts = tmp_path / "prompts.json"
+    prompts.write_text(json.dumps(PROMPTS))
+    questions = tmp_path / "questions.txt"
+    questions.write_text("What is JAK-STAT?\n\nWhat is TNFa?\n")
+    tool = tmp_path / "progeny.csv"
+    tool.write_text("pathway,score\nJAK-STAT,1.5\nTNFa,-0.3\n")
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "chatgse._batch",
+            "--prompts",
+            str(prompts),
+            "--questions",
+            str(questions),
+            "--context",
+            "PBMCs",
+            "--tool",
+            str(tool),
+            "--model",
+            "mock",
+            "--out",
+            str(tmp_path / out),
+            *extra,
+        ],
+    )
+    _batch.main()
+    return tmp_path / out
+
+
+def test_cli_writes_csv(fast_mock, monkeypatch, tmp_path):
+    out = _run_cli(monkeypatch, tmp_path, "answers.csv")
+
+    with open(out) as f:
+        rows = list(csv.DictReader(f))
+    assert [r["question"] for r in rows] == [
+        "What is JAK-STAT?",
+        "What is TNFa?",
+    ]
+    assert list(rows[0]) == _batch.COLUMNS
+    assert all(r["answer"].startswith("Mock response") for r in rows)
+    assert not any(r["error"] for r in rows)
+
+
+def test_cli_writes_jsonl(fast_mock, monkeypatch, tmp_path):
+    out = _run_cli(
+        monkeypatch, tmp_path, "answers.jsonl", "--split-correction"
+    )
+
+    results = [json.loads(line) for line in out.read_text().splitlines()]
+    assert len(results) == 2
+    assert all(r["correction"] is None for r in results)
+
+
+def test_setup_conversation_applies_prompts(fast_mock, tmp_path):
+    conversation = _batch.setup_conversation("mock", PROMPTS, "PBMCs")
+
+    contents = [m.content for m in conversation.messages]
+    assert contents == [
+        "You are an assistant.",
+        "The topic of the research is PBMCs.",
+    ]
+    assert [m.content for m in conversation.ca_messages] == [
+        "Check the statements."
+    ]
+
+
+def test_run_batch_keeps_setup(fast_mock, monkeypatch):
+    conversation = _batch.setup_conversation("mock", PROMPTS, "PBMCs")
+    conversation.append_user_message("The contrast is treated vs control.")
+    conversation.append_system_message("Tool results: JAK-STAT 1.5.")
+    setup = list(conversation.messages)
+    conversation.append_user_message("What is JAK-STAT?")
+    conversation.append_ai_message("A signalling pathway.")
+    sent = []
+    monkeypatch.setattr(
+        _batch,
+        "answer",
+        lambda conversation, messages, question: sent.append(messages),
+    )
+
+    _batch.run_batch(conversation, ["What is TNFa?"])
+
+    assert sent == [setup]
@@ -0,0 +1,105 @@
+import pytest
+from langchain.schema import HumanMessage, SystemMessage
+
+from chatgse import _cache
+from chatgse._cache import ResponseCache
+
+PROMPTS = {"primary_model_prompts": ["You are an assistant."]}
+MESSAGES = [
+    SystemMessage(content="You are an assistant."),
+    HumanMessage(content="What is JAK-STAT?"),
+]
+USAGE = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(_cache.time, "time", lambda: now[0])
+    return now
+
+
+def _cache_at(tmp_path, **kwargs):
+    return ResponseCache(str(tmp_path / "cache" / "responses.db"), **kwargs)
+
+
+def test_round_trip(tmp_path, clock):
+    cache = _cache_at(tmp_path)
+    key = ResponseCache.key("response", "gpt-3.5-turbo", PROMPTS, MESSAGES)
+
+    assert cache.get(key) is None
+    cache.put(key, "A signalling pathway.", USAGE)
+
+    assert cache.get(key) == ("A signalling pathway.", USAGE)
+    assert cache.metrics() == {
+        "entries": 1,
+        "hits": {"response": 1},
+        "misses": {"response": 1},
+    }
+
+
+def test_key():
+    key = ResponseCache.key("response", "gpt-3.5-turbo", PROMPTS, MESSAGES)
+
+    assert key == ResponseCache.key(
+        "response", "gpt-3.5-turbo", PROMPTS, list(MESSAGES)
+    )
+    assert key != ResponseCache.key(
+        "correction", "gpt-3.5-turbo", PROMPTS, MESSAGES
+    )
+    assert key != ResponseCache.key("response", "gpt-4", PROMPTS, MESSAGES)
+    assert key != ResponseCache.key(
+        "response", "gpt-3.5-turbo", PROMPTS, MESSAGES[:1]
+    )
+    assert key != ResponseCache.key(
+        "response", "gpt-3.5-turbo", PROMPTS, MESSAGES, "text"
+    )
+
+
+def test_ttl(tmp_path, clock):
+    cache = _cache_at(tmp_path, ttl=60)
+    cache.put("a", "first", USAGE)
+
+    clock[0] += 59
+    assert cache.get("a") == ("first", USAGE)
+
+    clock[0] += 1
+    assert cache.get("a") is None
+
+    # expired entries are removed on the next write
+    cache.put("b", "second", USAGE)
+    assert cache.metrics()["entries"] == 1
+
+
+def test_zero_ttl_disables_cache(tmp_path, clock):
+    cache = _cache_at(tmp_path, ttl=0)
+    cache.put("a", "first", USAGE)
+
+    assert not cache.enabled
+    assert cache.get("a") is None
+    assert cache.metrics()["entries"] == 0
+
+
+def test_evicts_least_recently_used(tmp_path, clock):
+    cache = _cache_at(tmp_path, max_entries=2)
+    cache.put("a", "first", USAGE)
+    clock[0] += 1
+    cache.put("b", "second", USAGE)
+    clock[0] += 1
+    cache.get("a")
+    clock[0] += 1
+    cache.put("c", "third", USAGE)
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+    assert cache.metrics()["entries"] == 2
+
+
+def test_shared_across_instances(tmp_path, clock):
+    _cache_at(tmp_path).put("a", "first", USAGE, namespace="correction")
+
+    cache = _cache_at(tmp_path)
+
+    assert cache.get("a", namespace="correction") == ("first", USAGE)
+    assert cache.metrics()["hits"] == {"correction": 1}
@@ -0,0 +1,107 @@
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
+from chatgse._compaction import (
+    COMPACTION_PREFIX,
+    chat_start,
+    compact_messages,
+)
+from chatgse._tokens import count_message_tokens
+
+
+def _conversation(n: int, system: str = "You are an assistant."):
+    messages = [SystemMessage(content=system)]
+    for i in range(n):
+        messages.append(HumanMessage(content=f"Question {i}?"))
+        messages.append(AIMessage(content=f"Answer {i}. " + "y" * 400))
+    return messages
+
+
+def test_fitting_conversation_is_kept():
+    messages = _conversation(2)
+
+    compacted, saved, over = compact_messages(messages, 10000)
+
+    assert compacted is messages
+    assert saved == over == 0
+
+
+def test_oldest_exchanges_are_summarised():
+    messages = _conversation(5)
+    budget = count_message_tokens(messages) // 2
+
+    compacted, saved, over = compact_messages(messages, budget)
+
+    assert over == 0
+    assert saved > 0
+    assert count_message_tokens(compacted) <= budget
+    assert compacted[0] is messages[0]
+    assert compacted[1].content.startswith(COMPACTION_PREFIX)
+    assert "Question 0?" in compacted[1].content
+    # the most recent exchange is kept
+    assert compacted[-2:] == messages[-2:]
+
+
+def test_reserve_counts_against_budget():
+    messages = _conversation(5)
+    budget = count_message_tokens(messages)
+
+    _, saved, over = compact_messages(messages, budget, reserve=100)
+
+    assert saved > 0
+    assert over == 0
+
+
+def test_summary_is_extended():
+    messages = _conversation(6)
+    budget = count_message_tokens(messages) * 2 // 3
+    compacted, _, _ = compact_messages(messages, budget)
+    compacted += _conversation(3)[1:]
+
+    again, _, _ = compact_messages(compacted, budget)
+
+    summaries = [
+        m for m in again if m.content.startswith(COMPACTION_PREFIX)
+    ]
+    assert len(summaries) == 1
+    assert "Question 0?" in summaries[0].content
+
+
+def test_over_budget_system_messages_are_signalled():
+    messages = _conversation(3, system="z" * 4000)
+
+    compacted, _, over = compact_messages(messages, 500)
+
+    assert over > 0
+    assert compacted[0] is messages[0]
+    assert count_message_tokens(compacted) - over == 500
+
+
+def _with_tool_data(n: int):
+    messages = _conversation(n)
+    setup = [
+        HumanMessage(content="The contrast is treated versus control."),
+        SystemMessage(content="Tool results: JAK-STAT 1.5, TNFa -0.3."),
+    ]
+    return messages[:1] + setup + messages[1:], setup
+
+
+def test_chat_start():
+    messages, setup = _with_tool_data(2)
+
+    assert chat_start(messages) == 3
+    assert chat_start(messages[:3]) == 3
+    assert chat_start([]) == 0
+
+
+def test_setup_description_is_kept():
+    messages, setup = _with_tool_data(5)
+    budget = count_message_tokens(messages) // 2
+
+    compacted, saved, over = compact_messages(messages, budget)
+
+    assert saved > 0
+    assert compacted[:3] == messages[:3]
+    summary = compacted[3]
+    assert summary.content.startswith(COMPACTION_PREFIX)
+    assert "contrast" not in summary.content
+    assert "Question 0?" in summary.content
@@ -0,0 +1,175 @@
+import json
+import threading
+
+import pytest
+
+from chatgse._correction import correct_batch, correct_query, parse_verdicts
+from chatgse._interface import _correct
+from chatgse._llm import QueryCancelled
+from chatgse._mock import MockConversation, MockModel
+from chatgse._scheduler import RequestScheduler
+
+PROMPTS = {
+    "primary_model_prompts": [],
+    "correcting_agent_prompts": ["Check the statements."],
+    "tool_prompts": {},
+}
+
+RESPONSE = " ".join(f"Sentence number {i} is short." for i in range(7))
+
+
+class CountingScheduler(RequestScheduler):
+    def __init__(self):
+        super().__init__(rpm=1000, tpm=1000000)
+        self.slots = []
+
+    def slot(self, session, tokens, on_position=None):
+        self.slots.append((session, tokens))
+        return super().slot(session, tokens, on_position)
+
+
+@pytest.fixture
+def conversation():
+    conversation = MockConversation(
+        model_name="mock",
+        prompts=PROMPTS,
+        split_correction=True,
+        model=MockModel(latency=0, sigma=0, error_rate=0),
+    )
+    conversation.set_api_key(user="community")
+    return conversation
+
+
+@pytest.mark.parametrize("batch_size, requests", [(1, 7), (3, 3)])
+def test_slot_per_request(conversation, batch_size, requests):
+    scheduler = CountingScheduler()
+
+    corrections = correct_query(
+        conversation,
+        RESPONSE,
+        batch_size=batch_size,
+        scheduler=scheduler,
+        session="s",
+    )
+
+    assert corrections == []
+    assert len(scheduler.slots) == requests
+    assert all(s == "s" and tokens > 0 for s, tokens in scheduler.slots)
+
+
+def test_whole_response_takes_one_slot(conversation):
+    conversation.split_correction = False
+    scheduler = CountingScheduler()
+
+    correct_query(conversation, RESPONSE, scheduler=scheduler, session="s")
+
+    assert len(scheduler.slots) == 1
+
+
+def test_own_key_is_not_scheduled(conversation):
+    conversation.set_api_key(user="default")
+    scheduler = CountingScheduler()
+
+    correct_query(conversation, RESPONSE, scheduler=scheduler, session="s")
+
+    assert scheduler.slots == []
+
+
+def test_interface_correction_is_scheduled_per_request(conversation):
+    scheduler = CountingScheduler()
+    conversation.correction_batch_size = 1
+
+    _correct(conversation, RESPONSE, scheduler=scheduler, session="s")
+
+    assert len(scheduler.slots) == 7
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_cancelled_correction_sends_nothing(conversation, batch_size):
+    scheduler = CountingScheduler()
+    cancel = threading.Event()
+    cancel.set()
+
+    with pytest.raises(QueryCancelled):
+        correct_query(
+            conversation,
+            RESPONSE,
+            batch_size=batch_size,
+            scheduler=scheduler,
+            session="s",
+            cancel=cancel,
+        )
+
+    assert scheduler.slots == []
+
+
+def test_parse_verdicts():
+    text = (
+        'Here you go: [{"sentence": 1, "correction": "OK"}, '
+        '{"sentence": 2, "correction": " JAK-STAT is a pathway. "}]'
+    )
+
+    assert parse_verdicts(text, 2) == {0: "OK", 1: "JAK-STAT is a pathway."}
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "OK",
+        "[not json]",
+        '{"sentence": 1, "correction": "OK"}',
+        '[{"sentence": 1, "correction": "OK"}',
+        "[1, 2]",
+    ],
+)
+def test_parse_malformed_verdicts(text):
+    assert parse_verdicts(text, 2) == {}
+
+
+def test_parse_short_and_invalid_verdicts():
+    text = json.dumps(
+        [
+            {"sentence": 2, "correction": "OK"},
+            {"sentence": 3, "correction": "out of range"},
+            {"sentence": 0, "correction": "out of range"},
+            {"sentence": "1", "correction": "not a number"},
+            {"sentence": 1, "correction": "  "},
+            {"sentence": 1},
+        ]
+    )
+
+    assert parse_verdicts(text, 2) == {1: "OK"}
+
+
+def test_missing_verdicts_are_checked_one_by_one(conversation):
+    checked = []
+    conversation.complete_correction = lambda messages: json.dumps(
+        [{"sentence": 1, "correction": "Wrong."}]
+    )
+    conversation._correct_response = lambda msg: checked.append(msg) or "OK"
+
+    result = correct_batch(conversation, ["First.", "Second.", "Third."])
+
+    assert result == ["Wrong.", "OK", "OK"]
+    assert checked == ["Second.", "Third."]
+
+
+def test_sentences_spanning_lines_keep_numbering(conversation):
+    sent = []
+
+    def complete_correction(messages):
+        sent.append(messages[-1].content)
+        return MockConversation.complete_correction(conversation, messages)
+
+    conversation.complete_correction = complete_correction
+    sentences = ["A list:\n- JAK-STAT\n- TNFa", "Second.", "Third."]
+
+    result = correct_batch(conversation, sentences)
+
+    assert result == ["OK"] * 3
+    assert sent[0].splitlines() == [
+        "1. A list: - JAK-STAT - TNFa",
+        "2. Second.",
+        "3. Third.",
+    ]
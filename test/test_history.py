@@ -0,0 +1,86 @@
+import json
+
+from chatgse._history import MessageLog
+
+ENTRIES = [
+    ("User", "What is JAK-STAT?"),
+    ("💬🧬 ChatGSE", "A signalling pathway."),
+    ("tool", "progeny"),
+    ("User", "And TNFa?"),
+    ("💬🧬 ChatGSE", 'A "cytokine".'),
+]
+
+
+def _render(role, msg):
+    return f"`{role}`: {msg}"
+
+
+def _is_table(role, msg):
+    return role == "tool"
+
+
+def test_blocks_join_messages_between_tables():
+    log = MessageLog(ENTRIES)
+
+    blocks = list(log.blocks(_render, alone=_is_table))
+
+    assert blocks == [
+        (
+            0,
+            "`User`: What is JAK-STAT?\n\n"
+            "`💬🧬 ChatGSE`: A signalling pathway.",
+        ),
+        (2, None),
+        (3, '`User`: And TNFa?\n\n`💬🧬 ChatGSE`: A "cytokine".'),
+    ]
+
+
+def test_blocks_of_range():
+    log = MessageLog(ENTRIES)
+
+    assert list(log.blocks(_render, 3, 4)) == [(3, "`User`: And TNFa?")]
+    assert list(log.blocks(_render, 4, 100)) == [
+        (4, '`💬🧬 ChatGSE`: A "cytokine".')
+    ]
+    assert list(MessageLog().blocks(_render)) == []
+
+
+def test_to_json_matches_legacy_format():
+    log = MessageLog(ENTRIES[:2])
+    assert log.to_json() == json.dumps(log.to_list())
+
+    # only appended messages are encoded again
+    log.append(*ENTRIES[3])
+    assert log.to_json() == json.dumps(log.to_list())
+    assert json.loads(log.to_json())[-1] == {"User": "And TNFa?"}
+
+
+def test_to_json_resolves_without_keeping():
+    log = MessageLog(ENTRIES)
+    tables = {"progeny": "| pathway |"}
+
+    def resolve(role, msg):
+        return tables[msg] if role == "tool" else None
+
+    exported = json.loads(log.to_json(resolve=resolve))
+
+    assert exported[2] == {"tool": "| pathway |"}
+    assert exported[0] == {"User": "What is JAK-STAT?"}
+    # the resolved content is neither cached per message nor joined
+    assert not any("| pathway |" in part for part in log._json_parts if part)
+    assert log._json is None
+    tables["progeny"] = "| score |"
+    assert json.loads(log.to_json(resolve=resolve))[2] == {
+        "tool": "| score |"
+    }
+
+
+def test_version_and_clear():
+    log = MessageLog(ENTRIES)
+    version = log.version
+
+    log.clear()
+
+    assert log.version > version
+    assert not log
+    assert log.to_json() == "[]"
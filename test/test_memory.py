@@ -0,0 +1,83 @@
+import gc
+import os
+import stat
+import time
+
+import pandas as pd
+import pytest
+
+from chatgse._memory import MemoryAccountant
+from chatgse._tables import TableStore
+
+
+def _table(n: int = 1000):
+    return pd.DataFrame({"gene": [f"G{i}" for i in range(n)], "x": range(n)})
+
+
+@pytest.fixture
+def accountant(tmp_path):
+    return MemoryAccountant(
+        limit_mb=0.001, idle_seconds=0.001, spill_dir=str(tmp_path)
+    )
+
+
+def test_spill_dir_is_private(accountant, tmp_path):
+    assert os.path.dirname(accountant.spill_dir) == str(tmp_path)
+    mode = stat.S_IMODE(os.stat(accountant.spill_dir).st_mode)
+    assert mode == 0o700
+
+
+def test_spill_and_reload(tmp_path):
+    tables = TableStore()
+    df = _table()
+    ref = tables.add("progeny", df)
+
+    freed = tables.spill(str(tmp_path))
+
+    assert freed > 0
+    assert tables.nbytes == 0
+    assert len(os.listdir(tmp_path)) == 1
+    pd.testing.assert_frame_equal(tables.get(ref), df)
+    assert tables.nbytes == freed
+    assert os.listdir(tmp_path) == []
+
+
+def test_spilled_files_removed_with_store(tmp_path):
+    tables = TableStore()
+    tables.add("progeny", _table())
+    tables.spill(str(tmp_path))
+    assert os.listdir(tmp_path)
+
+    del tables
+    gc.collect()
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_enforce_spills_idle_sessions(accountant):
+    idle, active = TableStore(), TableStore()
+    idle.add("progeny", _table())
+    active.add("progeny", _table())
+    accountant.update("idle", {"tables": idle})
+
+    # sessions become idle after idle_seconds without an update
+    time.sleep(0.01)
+    accountant.update("active", {"tables": active})
+    accountant.idle_seconds = 0.005
+    accountant.enforce()
+
+    assert idle.nbytes == 0
+    assert active.nbytes > 0
+    assert accountant.metrics()["spilled_bytes"] > 0
+    assert accountant.footprint("idle") < accountant.footprint("active")
+
+
+def test_enforce_drops_gone_sessions(accountant):
+    tables = TableStore()
+    accountant.update("gone", {"tables": tables})
+    del tables
+    gc.collect()
+
+    accountant.enforce()
+
+    assert accountant.metrics()["sessions"] == 0
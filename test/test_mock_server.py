@@ -0,0 +1,100 @@
+import threading
+import types
+
+import openai
+import pytest
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import HumanMessage, SystemMessage
+
+from chatgse._http import ClientPool
+from chatgse._llm import completion, resilient_completion
+from chatgse._mock import MockModel
+from chatgse._mock_server import MockServer
+
+MESSAGES = [
+    SystemMessage(content="You are an assistant."),
+    HumanMessage(content="What is JAK-STAT?"),
+]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    for name in ["HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy"]:
+        monkeypatch.delenv(name, raising=False)
+    server = MockServer(
+        ("127.0.0.1", 0),
+        MockModel(latency=0, sigma=0, tokens=5, token_delay=0, error_rate=0),
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    monkeypatch.setattr(openai, "api_base", f"http://{host}:{port}/v1")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def conversation(server):
+    chat = ChatOpenAI(
+        model_name="gpt-3.5-turbo",
+        openai_api_key="sk-test",
+        max_retries=0,
+    )
+    return types.SimpleNamespace(chat=chat, model_name="gpt-3.5-turbo")
+
+
+def test_completion(conversation):
+    msg, token_usage = completion(conversation, MESSAGES)
+
+    assert msg.startswith("Mock response to 'What is JAK-STAT?'")
+    assert token_usage["completion_tokens"] == 5
+    assert not token_usage.get("estimated")
+
+
+def test_streamed_completion(conversation):
+    tokens = []
+
+    msg, token_usage = completion(
+        conversation, MESSAGES, on_token=tokens.append
+    )
+
+    assert "".join(tokens) == msg
+    # langchain also reports the empty role and stop chunks
+    assert len([t for t in tokens if t]) == 5
+    # the stream reports no usage
+    assert token_usage["estimated"]
+
+
+def test_failed_requests_are_retried(conversation, server):
+    server.model.error_rate = 1
+    retries = []
+
+    msg, token_usage = resilient_completion(
+        conversation,
+        MESSAGES,
+        on_retry=retries.append,
+        retries=1,
+        backoff=0,
+    )
+
+    assert token_usage is None
+    assert retries == [1]
+    assert "Injected error" in msg
+
+
+def test_pool_reuses_connections(conversation, monkeypatch):
+    pool = ClientPool(size=2)
+    monkeypatch.setattr(openai, "requestssession", None)
+    # openai keeps the sessions it made before in its request threads
+    monkeypatch.setattr(
+        openai.api_requestor, "_thread_context", threading.local()
+    )
+    pool.install()
+
+    for _ in range(3):
+        completion(conversation, MESSAGES)
+
+    (row,) = pool.metrics()
+    assert row["requests"] == 3
+    assert row["connections"] == 1
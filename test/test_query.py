@@ -0,0 +1,187 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from chatgse import _llm
+from chatgse._cache import ResponseCache
+from chatgse._history import MessageLog
+from chatgse._interface import ChatGSE
+from chatgse._llm import record_usage
+from chatgse._mock import MockConversation, MockModel
+
+PROMPTS = {
+    "primary_model_prompts": ["You are an assistant."],
+    "correcting_agent_prompts": ["Check the statements."],
+    "tool_prompts": {},
+}
+
+
+@pytest.fixture
+def ss(session_state):
+    session_state.primary_model = "mock"
+    session_state.conversation = MockConversation(
+        "mock",
+        PROMPTS,
+        model=MockModel(latency=0, sigma=0, token_delay=0, error_rate=0),
+    )
+    session_state.conversation.set_api_key(user="default")
+    session_state.conversation.setup("PBMCs")
+    session_state.conversation.set_user_name("Ada")
+    session_state.history = MessageLog()
+    session_state.token_limit = 4097
+    return session_state
+
+
+def test_query_adds_exchange(ss):
+    cg = ChatGSE.__new__(ChatGSE)
+    n = len(ss.conversation.messages)
+
+    msg, token_usage, correction = cg._query("What is JAK-STAT?")
+
+    assert token_usage["total_tokens"] > 0
+    assert correction is None
+    assert ss.pending_correction.result() == []
+    messages = ss.conversation.messages[n:]
+    assert [(m.type, m.content) for m in messages] == [
+        ("human", "What is JAK-STAT?"),
+        ("ai", msg),
+    ]
+    # the hook is only in place during the query
+    assert "_primary_query" not in vars(ss.conversation)
+
+
+def test_query_without_correction_returns_ok(ss):
+    ss.conversation.correct = False
+    cg = ChatGSE.__new__(ChatGSE)
+
+    _, _, correction = cg._query("What is JAK-STAT?")
+
+    assert correction == "OK"
+    assert ss.conversation.correct is False
+    assert "pending_correction" not in ss
+
+
+def test_failed_query_takes_back_message(ss, monkeypatch):
+    monkeypatch.setattr(_llm, "RETRIES", 0)
+    ss.conversation.model = MockModel(latency=0, sigma=0, error_rate=1)
+    cg = ChatGSE.__new__(ChatGSE)
+    n = len(ss.conversation.messages)
+
+    msg, token_usage, _ = cg._query("What is JAK-STAT?")
+
+    assert token_usage is None
+    assert len(ss.conversation.messages) == n
+
+
+class Recorder:
+    def __init__(self):
+        self.stats = []
+
+    def _update_usage_stats(self, model, token_usage):
+        self.stats.append((model, token_usage))
+
+
+def test_estimated_usage_is_counted_apart():
+    conversation = Recorder()
+    usage = {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}
+
+    record_usage(conversation, "gpt-3.5-turbo", usage)
+    record_usage(conversation, "gpt-3.5-turbo", dict(usage, estimated=True))
+
+    assert conversation.stats == [
+        ("gpt-3.5-turbo", usage),
+        (
+            "gpt-3.5-turbo",
+            {
+                "estimated_prompt_tokens": 3,
+                "estimated_completion_tokens": 2,
+                "estimated_total_tokens": 5,
+            },
+        ),
+    ]
+
+
+def test_cache_hit_reports_cached_usage(ss, tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.db"))
+    ss.conversation.correct = False
+    cg = ChatGSE.__new__(ChatGSE)
+    messages = list(ss.conversation.messages)
+
+    msg, usage, _ = cg._query("What is JAK-STAT?", cache=cache)
+    ss.conversation.messages = list(messages)
+    cached_msg, cached_usage, _ = cg._query("What is JAK-STAT?", cache=cache)
+
+    assert cached_msg == msg
+    assert cached_usage["cached"]
+    assert cached_usage["total_tokens"] == usage["total_tokens"] > 0
+
+
+def test_complete_history_follows_conversation(ss):
+    cg = ChatGSE.__new__(ChatGSE)
+    conversation = ss.conversation
+
+    assert cg.complete_history() == conversation.get_msg_json()
+    version = ss.complete_history.version
+
+    conversation.append_user_message("What is JAK-STAT?")
+    assert cg.complete_history() == conversation.get_msg_json()
+    # only the new message was added
+    assert ss.complete_history.version == version + 1
+
+    # earlier messages replaced, e.g. by compaction
+    conversation.messages = conversation.messages[:1] + [
+        conversation.messages[-1]
+    ]
+    assert cg.complete_history() == conversation.get_msg_json()
+
+    # a message taken back
+    del conversation.messages[-1]
+    assert cg.complete_history() == conversation.get_msg_json()
+
+
+def test_get_response_and_correction(ss):
+    ss.input = "What is JAK-STAT?"
+    cg = ChatGSE.__new__(ChatGSE)
+
+    response, token_usage = cg._get_response()
+    cg._collect_correction(wait=True)
+
+    assert token_usage["total_tokens"] > 0
+    assert [role for role, _ in ss.history] == [
+        "Ada",
+        "💬🧬 ChatGSE",
+    ]
+    assert ss.pending_correction is None
+
+
+def test_collect_correction_waits_for_pending(ss):
+    ss.conversation.split_correction = False
+    release = threading.Event()
+    with ThreadPoolExecutor(1) as executor:
+        ss.pending_correction = executor.submit(
+            lambda: release.wait(5) and ["Not quite."]
+        )
+        cg = ChatGSE.__new__(ChatGSE)
+
+        assert not cg._collect_correction()
+        threading.Timer(0.1, release.set).start()
+        assert cg._collect_correction(wait=True)
+
+    assert list(ss.history) == [("🕵️ Correcting agent", "Not quite.")]
+    assert ss.pending_correction is None
+
+
+def test_preflight_blocks_long_input(ss):
+    ss.token_limit = 300
+    ss.input = "JAK-STAT " * 500
+    cg = ChatGSE.__new__(ChatGSE)
+    n = len(ss.conversation.messages)
+
+    response, token_usage = cg._get_response()
+
+    assert token_usage is None
+    assert len(ss.conversation.messages) == n
+    ((role, msg),) = list(ss.history)
+    assert role == "📎 Assistant"
+    assert "shorten your message" in msg
@@ -0,0 +1,92 @@
+import pytest
+from langchain.schema import HumanMessage, SystemMessage
+
+from chatgse import _interface
+from chatgse._interface import ChatGSE
+from chatgse._mock import MockConversation
+from chatgse._session_store import SessionStore
+
+PROMPTS = {
+    "primary_model_prompts": ["You are an assistant."],
+    "correcting_agent_prompts": ["Check the statements."],
+    "tool_prompts": {},
+}
+
+
+@pytest.fixture
+def ss(monkeypatch, session_state):
+    state = session_state
+    state.update(
+        user="default",
+        primary_model="mock",
+        prompts=PROMPTS,
+        session_token="new-token",
+    )
+    state.conversation = MockConversation("mock", PROMPTS)
+    params = {}
+    monkeypatch.setattr(
+        _interface.st,
+        "experimental_set_query_params",
+        lambda **kwargs: params.update(kwargs),
+    )
+    state.query_params = params
+    return state
+
+
+def _session(key: str, user: str = "default"):
+    return {
+        "mode": "chat",
+        "prompts": PROMPTS,
+        "state": {
+            "primary_model": "mock",
+            "user": user,
+            "asked_for_name": True,
+            "key_fingerprint": SessionStore.fingerprint(key),
+        },
+        "history": [("User", "secret question")],
+        "messages": [
+            SystemMessage(content="You are an assistant."),
+            HumanMessage(content="secret question"),
+        ],
+        "ca_messages": [SystemMessage(content="Check the statements.")],
+        "tables": {},
+    }
+
+
+def test_restore_waits_for_key(ss):
+    cg = ChatGSE.__new__(ChatGSE)
+    cg.restore_session("old-token", _session("sk-owner"))
+
+    assert "history" not in ss
+    assert "openai_api_key" not in ss
+    assert ss.session_token == "new-token"
+
+
+def test_matching_key_resumes(ss):
+    cg = ChatGSE.__new__(ChatGSE)
+    cg.restore_session("old-token", _session("sk-owner"))
+
+    assert cg._resume_session("sk-owner")
+    assert ss.session_token == "old-token"
+    assert list(ss.history) == [("User", "secret question")]
+    assert ss.conversation.messages[-1].content == "secret question"
+    assert ss.restored_mode == "chat"
+
+
+def test_other_key_starts_new_session(ss):
+    cg = ChatGSE.__new__(ChatGSE)
+    cg.restore_session("old-token", _session("sk-owner"))
+
+    assert not cg._resume_session("sk-other")
+    assert ss.session_token == "new-token"
+    assert ss.query_params == {"session": "new-token"}
+    assert "history" not in ss
+    assert "pending_restore" not in ss
+
+
+def test_community_session_needs_community_user(ss):
+    cg = ChatGSE.__new__(ChatGSE)
+    cg.restore_session("old-token", _session("sk-community", "community"))
+
+    # the same key, but the user did not choose the community key
+    assert not cg._resume_session("sk-community")
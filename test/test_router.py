@@ -0,0 +1,48 @@
+import pytest
+
+from chatgse._router import route, router_limit, router_models
+
+
+@pytest.fixture(autouse=True)
+def models(monkeypatch):
+    monkeypatch.setenv(
+        "CHATGSE_ROUTER_MODELS", "gpt-3.5-turbo,gpt-3.5-turbo-16k,gpt-4"
+    )
+
+
+def test_router_models():
+    assert router_models() == ["gpt-3.5-turbo", "gpt-3.5-turbo-16k", "gpt-4"]
+
+
+def test_unknown_models_are_ignored(monkeypatch):
+    monkeypatch.setenv("CHATGSE_ROUTER_MODELS", "gpt-3.5-turbo, davinci")
+    assert router_models() == ["gpt-3.5-turbo"]
+
+
+def test_route_cheapest_fitting():
+    models = router_models()
+    assert route(100, 256, models) == "gpt-3.5-turbo"
+    assert route(5000, 256, models) == "gpt-3.5-turbo-16k"
+    assert route(20000, 256, models) is None
+    assert router_limit(models) == 16000
+
+
+def test_selected_tier_is_kept():
+    assert router_models("gpt-4") == ["gpt-4"]
+    assert route(100, 256, router_models("gpt-4")) == "gpt-4"
+    assert set(router_models("gpt-3.5-turbo")) == {
+        "gpt-3.5-turbo",
+        "gpt-3.5-turbo-16k",
+    }
+
+
+def test_no_upgrade():
+    assert router_models("gpt-3.5-turbo", upgrade=False) == ["gpt-3.5-turbo"]
+    assert set(router_models("gpt-3.5-turbo-16k", upgrade=False)) == {
+        "gpt-3.5-turbo",
+        "gpt-3.5-turbo-16k",
+    }
+
+
+def test_unknown_selected_model():
+    assert router_models("text-davinci-003") == []
@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+
+from chatgse._scheduler import RequestScheduler
+
+
+def _enqueue(scheduler, session, tokens, granted):
+    """
+    Start a request in a thread, and wait until it is queued.
+    """
+    queued = scheduler.queued()
+
+    def run():
+        with scheduler.slot(session, tokens):
+            granted.append(session)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while scheduler.queued() == queued and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return thread
+
+
+def test_free_requests_pass():
+    scheduler = RequestScheduler(rpm=60, tpm=1000)
+
+    with scheduler.slot("a", 100) as ticket:
+        assert ticket.tokens == 100
+
+    assert scheduler.queued() == 0
+
+
+def test_sessions_are_served_round_robin():
+    scheduler = RequestScheduler(rpm=600, tpm=100000)
+    # empty request bucket: one request every 0.1 s
+    scheduler._requests = 0
+    granted = []
+
+    threads = [_enqueue(scheduler, "a", 1, granted) for _ in range(3)]
+    threads.append(_enqueue(scheduler, "b", 1, granted))
+    for thread in threads:
+        thread.join(5)
+
+    assert granted == ["a", "b", "a", "a"]
+
+
+def test_token_bucket_delays_large_requests():
+    scheduler = RequestScheduler(rpm=1000, tpm=600)
+    scheduler._tokens = 0
+
+    start = time.monotonic()
+    with scheduler.slot("a", 5):
+        pass
+
+    # 10 tokens per second
+    assert time.monotonic() - start >= 0.4
+
+
+def test_queue_position():
+    scheduler = RequestScheduler(rpm=600, tpm=100000)
+    scheduler._requests = 0
+    positions = []
+    granted = []
+
+    first = _enqueue(scheduler, "a", 1, granted)
+    with scheduler.slot("b", 1, on_position=positions.append):
+        pass
+    first.join(5)
+
+    assert positions[0] == 1
+    assert positions[-1] == 0
+
+
+def test_settle_corrects_tokens():
+    scheduler = RequestScheduler(rpm=60, tpm=1000)
+
+    with scheduler.slot("a", 100) as ticket:
+        ticket.settle(300)
+
+    assert scheduler._tokens == pytest.approx(700, abs=1)
+
+
+def test_failed_wait_leaves_queue():
+    scheduler = RequestScheduler(rpm=60, tpm=1000)
+    scheduler._requests = 0
+
+    def stop(position):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        with scheduler.slot("a", 1, on_position=stop):
+            pass
+
+    assert scheduler.queued() == 0
@@ -0,0 +1,181 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+from langchain.schema import AIMessage, HumanMessage, SystemMessage
+
+from chatgse._session_store import SessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SessionStore(str(tmp_path / "sessions.db"), flush_interval=0.05)
+
+
+def _write_session(store, token: str):
+    df = pd.DataFrame({"pathway": ["JAK-STAT", "TNFa"], "score": [1.5, -0.3]})
+    messages = [
+        SystemMessage(content="You are an assistant."),
+        HumanMessage(content="What is JAK-STAT?"),
+        AIMessage(content="A signalling pathway."),
+    ]
+    ops = [
+        store.session_op(
+            token, "chat", {"primary_model_prompts": ["p"]}, {"user": "x"}
+        ),
+        store.history_op(token, 0, "User", "What is JAK-STAT?"),
+        store.history_op(token, 1, "💬🧬 ChatGSE", "A signalling pathway."),
+        store.table_op(token, "progeny", df),
+    ]
+    ops += [
+        store.message_op(token, "messages", i, m)
+        for i, m in enumerate(messages)
+    ]
+    ops.append(store.message_op(token, "ca_messages", 0, messages[0]))
+    store.put(ops, token)
+    return df, messages
+
+
+def test_round_trip(store):
+    token = SessionStore.new_token()
+    df, messages = _write_session(store, token)
+
+    session = store.load(token)
+
+    assert session["mode"] == "chat"
+    assert session["prompts"] == {"primary_model_prompts": ["p"]}
+    assert session["state"] == {"user": "x"}
+    assert session["history"] == [
+        ("User", "What is JAK-STAT?"),
+        ("💬🧬 ChatGSE", "A signalling pathway."),
+    ]
+    assert [(m.type, m.content) for m in session["messages"]] == [
+        (m.type, m.content) for m in messages
+    ]
+    assert [m.content for m in session["ca_messages"]] == [
+        "You are an assistant."
+    ]
+    pd.testing.assert_frame_equal(session["tables"]["progeny"], df)
+
+
+def test_truncate(store):
+    token = SessionStore.new_token()
+    _write_session(store, token)
+    store.put(
+        [
+            store.truncate_history_op(token, 1),
+            store.truncate_messages_op(token, "messages", 1),
+        ],
+        token,
+    )
+
+    session = store.load(token)
+
+    assert session["history"] == [("User", "What is JAK-STAT?")]
+    assert [m.type for m in session["messages"]] == ["system"]
+
+
+def test_unknown_token(store):
+    assert store.load("unknown") is None
+
+
+def test_load_does_not_wait_for_other_sessions(store):
+    mine, other = SessionStore.new_token(), SessionStore.new_token()
+    _write_session(store, mine)
+    store.load(mine)
+
+    # writes of another session that block in the writer thread
+    entered, release = threading.Event(), threading.Event()
+
+    def slow():
+        entered.set()
+        release.wait(5)
+        return (other, "chat", "{}", "{}", 0)
+
+    store.put(
+        [("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)", slow)],
+        other,
+    )
+    assert entered.wait(5)
+    try:
+        assert store.load(mine)["mode"] == "chat"
+    finally:
+        release.set()
+    assert store.load(other)["mode"] == "chat"
+
+
+def test_fingerprint():
+    assert SessionStore.fingerprint(None) is None
+    assert SessionStore.fingerprint("sk-a") == SessionStore.fingerprint("sk-a")
+    assert SessionStore.fingerprint("sk-a") != SessionStore.fingerprint("sk-b")
+    assert "sk-a" not in SessionStore.fingerprint("sk-a")
+
+
+def _count_rows(store, token: str):
+    with store._lock:
+        return sum(
+            store._conn.execute(
+                f"SELECT COUNT(*) FROM {table} WHERE token = ?", (token,)
+            ).fetchone()[0]
+            for table in ["sessions", "history", "messages", "tables"]
+        )
+
+
+def test_purge_expired(store):
+    old, new = SessionStore.new_token(), SessionStore.new_token()
+    _write_session(store, old)
+    store.wait(old)
+    cutoff = time.time()
+    time.sleep(0.01)
+    _write_session(store, new)
+    store.wait(new)
+
+    store.purge(cutoff + 0.005)
+
+    assert store.load(old) is None
+    assert _count_rows(store, old) == 0
+    assert store.load(new)["mode"] == "chat"
+
+
+def test_writes_renew_retention(store):
+    token = SessionStore.new_token()
+    _write_session(store, token)
+    store.wait(token)
+    cutoff = time.time()
+    time.sleep(0.01)
+
+    store.put([store.history_op(token, 2, "User", "And TNFa?")], token)
+    store.wait(token)
+    store.purge(cutoff + 0.005)
+
+    assert len(store.load(token)["history"]) == 3
+
+
+def test_delete(store):
+    token = SessionStore.new_token()
+    _write_session(store, token)
+
+    store.put(SessionStore.delete_ops(token), token)
+
+    assert store.load(token) is None
+    assert _count_rows(store, token) == 0
+
+
+def test_retention_on_open(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SessionStore(path)
+    token = SessionStore.new_token()
+    _write_session(store, token)
+    store.wait(token)
+
+    assert SessionStore(path).load(token) is not None
+    assert SessionStore(path, retention_days=-1).load(token) is None
+
+
+def test_empty_put_is_not_pending(store):
+    token = SessionStore.new_token()
+
+    store.put([], token)
+
+    assert token not in store._pending
@@ -0,0 +1,71 @@
+import types
+
+import pytest
+from langchain.schema import HumanMessage, SystemMessage
+
+from chatgse import _tokens
+from chatgse._tokens import count_message_tokens, count_tokens, encoding
+
+
+@pytest.fixture
+def tokeniser(monkeypatch):
+    """
+    A tiktoken whose download fails until `available` is set.
+    """
+    state = types.SimpleNamespace(available=False, calls=0)
+
+    def encoding_for_model(model):
+        state.calls += 1
+        if model == "not-openai":
+            raise KeyError(model)
+        if not state.available:
+            raise ConnectionError("no network")
+        return "encoding"
+
+    monkeypatch.setattr(
+        _tokens,
+        "tiktoken",
+        types.SimpleNamespace(encoding_for_model=encoding_for_model),
+    )
+    monkeypatch.setattr(_tokens, "_encodings", {})
+    monkeypatch.setattr(_tokens, "_failures", {})
+    return state
+
+
+def test_failed_load_is_retried(tokeniser):
+    assert encoding("gpt-3.5-turbo") is None
+    # within the backoff, the load is not tried again
+    assert encoding("gpt-3.5-turbo") is None
+    assert tokeniser.calls == 1
+
+    tokeniser.available = True
+    # the backoff has passed
+    _tokens._failures["gpt-3.5-turbo"] = (0, _tokens.RETRY_AFTER)
+    assert encoding("gpt-3.5-turbo") == "encoding"
+    assert encoding("gpt-3.5-turbo") == "encoding"
+    assert tokeniser.calls == 2
+
+
+def test_backoff_doubles(tokeniser):
+    encoding("gpt-3.5-turbo")
+    _, delay = _tokens._failures["gpt-3.5-turbo"]
+    _tokens._failures["gpt-3.5-turbo"] = (0, delay)
+
+    encoding("gpt-3.5-turbo")
+
+    assert _tokens._failures["gpt-3.5-turbo"][1] == 2 * delay
+
+
+def test_unknown_model_is_cached(tokeniser):
+    assert encoding("not-openai") is None
+    assert encoding("not-openai") is None
+    assert tokeniser.calls == 1
+
+
+def test_heuristic_without_tokeniser(tokeniser):
+    assert count_tokens("") == 0
+    assert count_tokens("a" * 40, "gpt-3.5-turbo") == 11
+    messages = [SystemMessage(content="a" * 40), HumanMessage(content="b")]
+    assert count_message_tokens(messages, "gpt-3.5-turbo") == (
+        _tokens.TOKENS_PER_PROMPT + 2 * _tokens.TOKENS_PER_MESSAGE + 11 + 1
+    )